@@ -22,10 +22,20 @@
 #
 
 from collections import namedtuple
+import hashlib
 import logging
 import os
 import re
+import sqlite3
 import tarfile
+import threading
+import time
+
+from cache import hash_file
+from depmatch import RuleMatcher
+from mapindex import MapIndex
+import mapindex
+import setupini
 
 
 PackageKind = namedtuple('PackageKind', 'kind script depends')
@@ -42,82 +52,213 @@ cross_package_prefixes = {
 # analyze the source package
 #
 
-def analyze(srcpkg, indir):
+def analyze(srcpkg, indir, arch=None):
     try:
-        with tarfile.open(srcpkg) as tf:
-            cygports = [m for m in tf.getmembers() if re.search(r'\.cygport$', m.name)]
-
-            # more than one cygport!
-            if len(cygports) > 1:
-                logging.error('srcpkg %s contains multiple .cygport files' % srcpkg)
-                return PackageKind(None, '', '')
-
-            # exactly one cygport file
-            if len(cygports) == 1:
-                fn = cygports[0].name
-                f = tf.extractfile(cygports[0])
-                content = f.read().decode()
-
-                # fold any line-continuations
-                content = re.sub(r'\\\n', '', content)
-
-                # does it have a DEPEND line?
-
-                # XXX: Note that this only approximates the value of DEPEND.
-                # The only accurate way to evaluate it is to execute the
-                # cygport, but doing so on the host seems contra-indicated.
-                depend = ''
-                for l in content.splitlines():
-                    match = re.match(r'^\s*DEPEND(?:\+|)=\s*"(.*?)"', l)
-                    if match:
-                        depend += match.group(1) + ' '
+        (cygports, scripts) = scan_srcpkg(srcpkg)
+    except tarfile.TarError:
+        logging.error("couldn't read srcpkg %s" % srcpkg)
+        return PackageKind(None, '', '')
 
-                if depend:
-                    logging.info('srcpkg contains cygport %s, with DEPEND' % fn)
-                    depends = set.union(depends_from_depend(depend),
-                                        depends_from_hardcoded(srcpkg, indir))
-                    return PackageKind('cygport-with-depends', script=fn, depends=','.join(sorted(depends)))
-                else:
-                    logging.info('srcpkg contains cygport %s' % fn)
-                    depends = set.union(depends_from_hints(srcpkg, indir),
-                                        depends_from_cygport(content),
-                                        depends_from_hardcoded(srcpkg, indir))
-                    return PackageKind('cygport-guessed-depends', script=fn, depends=','.join(sorted(depends)))
-
-            # if there's no cygport file, we look for a g-b-s style .sh file instead
-            scripts = [m for m in tf.getmembers() if re.search(r'\.sh$', m.name)]
-            if len(scripts) == 1:
-                fn = scripts[0].name
-                f = tf.extractfile(scripts[0])
-
-                # analyze it's content to classify as cygbuild or g-b-s
-                # (some copies of cygbuild contain a latin1 encoded 'í' i-acute)
-                content = f.read().decode(errors='replace')
-                if re.search('^CYGBUILD', content, re.MULTILINE):
-                    kind = 'cygbuild'
-                else:
-                    kind = 'g-b-s'
-
-                logging.info('srcpkg contains a %s-style build script %s' % (kind, fn))
-                depends = set.union(depends_from_hints(srcpkg, indir),
-                                    depends_from_cygbuild(),
-                                    depends_from_hardcoded(srcpkg, indir))
-                return PackageKind(kind, script=fn, depends=','.join(sorted(depends)))
-            elif len(scripts) > 1:
-                logging.error('too many scripts in srcpkg %s', srcpkg)
-                return PackageKind(None, '', '')
-
-        logging.error("couldn't find build instructions in srcpkg %s" % srcpkg)
+    # more than one cygport!
+    if len(cygports) > 1:
+        logging.error('srcpkg %s contains multiple .cygport files' % srcpkg)
         return PackageKind(None, '', '')
-    except tarfile.ReadError:
-        logging.error("couldn't read srcpkg %s" % srcpkg)
+
+    # exactly one cygport file
+    if len(cygports) == 1:
+        (fn, content) = cygports[0]
+        content = content.decode()
+
+        # fold any line-continuations
+        content = re.sub(r'\\\n', '', content)
+
+        # does it have a DEPEND line?
+
+        # XXX: Note that this only approximates the value of DEPEND.
+        # The only accurate way to evaluate it is to execute the
+        # cygport, but doing so on the host seems contra-indicated.
+        depend = ''
+        for l in content.splitlines():
+            match = re.match(r'^\s*DEPEND(?:\+|)=\s*"(.*?)"', l)
+            if match:
+                depend += match.group(1) + ' '
+
+        if depend:
+            logging.info('srcpkg contains cygport %s, with DEPEND' % fn)
+            depends = set.union(depends_from_depend(depend),
+                                depends_from_hardcoded(srcpkg, indir))
+            return PackageKind('cygport-with-depends', script=fn, depends=','.join(minimal_depends(depends, arch)))
+        else:
+            logging.info('srcpkg contains cygport %s' % fn)
+            depends = set.union(depends_from_hints(srcpkg, indir),
+                                depends_from_cygport(content),
+                                depends_from_hardcoded(srcpkg, indir))
+            return PackageKind('cygport-guessed-depends', script=fn, depends=','.join(minimal_depends(depends, arch)))
+
+    # if there's no cygport file, we look for a g-b-s style .sh file instead
+    if len(scripts) == 1:
+        (fn, content) = scripts[0]
+
+        # analyze it's content to classify as cygbuild or g-b-s
+        # (some copies of cygbuild contain a latin1 encoded 'í' i-acute)
+        content = content.decode(errors='replace')
+        if re.search('^CYGBUILD', content, re.MULTILINE):
+            kind = 'cygbuild'
+        else:
+            kind = 'g-b-s'
+
+        logging.info('srcpkg contains a %s-style build script %s' % (kind, fn))
+        depends = set.union(depends_from_hints(srcpkg, indir),
+                            depends_from_cygbuild(),
+                            depends_from_hardcoded(srcpkg, indir))
+        return PackageKind(kind, script=fn, depends=','.join(minimal_depends(depends, arch)))
+    elif len(scripts) > 1:
+        logging.error('too many scripts in srcpkg %s', srcpkg)
         return PackageKind(None, '', '')
 
+    logging.error("couldn't find build instructions in srcpkg %s" % srcpkg)
+    return PackageKind(None, '', '')
+
+#
+# reduce the build dependencies to the minimal set to install, using the package
+# graph from setup.ini for |arch| (if we have one)
+#
+
+def minimal_depends(depends, arch):
+    graph = setupini.graph(arch) if arch else None
+    if graph is None:
+        return sorted(depends)
+
+    (minimal, installs) = graph.minimal(depends)
+    dropped = set(depends) - minimal
+    if dropped:
+        logging.info('dropped build dependencies (in base image, or required by others): %s' % (','.join(sorted(dropped))))
+    logging.info('build dependencies (minimal): %s, installing %d packages' % (','.join(sorted(minimal)), len(installs)))
+
+    return sorted(minimal)
+
+#
+# a persistent cache of analyze() results, in a table in the database
+#
+# These are keyed by a digest of everything analyze() looks at: the content of
+# the srcpkg, the package name, the setup.hint files (and the subpackage
+# directories) in indir, the mapping files used to determine dependencies
+# (and this file itself), and the setup.ini used to minimize them, so when any
+# of those change, the cached result is no longer used.
+#
+
+class AnalysisCache:
+    def __init__(self, dbpath):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(dbpath, check_same_thread=False, timeout=60)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS analysis
+                             (key text primary key, kind text, script text, depends text, timestamp integer)''')
+        self.conn.commit()
+
+    def analyze(self, srcpkg, indir, arch=None):
+        key = analysis_key(srcpkg, indir, arch)
+
+        with self.lock:
+            row = self.conn.execute('SELECT kind, script, depends FROM analysis WHERE key = ?', (key,)).fetchone()
+
+        if row:
+            package = PackageKind(*row)
+            logging.info('using cached analysis of srcpkg: kind %s, script %s, depends %s' % package)
+            return package
+
+        package = analyze(srcpkg, indir, arch)
+
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?)',
+                              (key, package.kind, package.script, package.depends, time.time()))
+            self.conn.commit()
+
+        return package
+
+
+# the mapping files, and this file, only change rarely, so remember their digest
+# until they are modified
+_versions = {}
+_versions_lock = threading.Lock()
+
+def _versions_digest():
+    files = [os.path.join(mapindex.basedir, fn) for fn in ['devel_package_map', 'pkgconfig-map', 'per-package-deps']] + [__file__]
+    stats = tuple((os.path.getmtime(fn), os.path.getsize(fn)) for fn in files)
+
+    with _versions_lock:
+        if _versions.get('stats') != stats:
+            h = hashlib.sha256()
+            for fn in files:
+                hash_file(h, fn)
+            _versions['stats'] = stats
+            _versions['digest'] = h.hexdigest()
+
+        return _versions['digest']
+
+
+def analysis_key(srcpkg, indir, arch=None):
+    h = hashlib.sha256()
+    h.update(_versions_digest().encode())
+
+    graph = setupini.graph(arch) if arch else None
+    if graph:
+        h.update(graph.version.encode())
+    h.update(os.path.split(indir)[1].encode() + b'\0')
+    hash_file(h, srcpkg)
+
+    for (dirpath, subdirs, files) in sorted(os.walk(indir)):
+        h.update(os.path.relpath(dirpath, indir).encode() + b'\0')
+        if 'setup.hint' in files:
+            hash_file(h, os.path.join(dirpath, 'setup.hint'))
+            h.update(b'\0')
+
+    return h.hexdigest()
+
+#
+# scan the members of the source package in a single pass, in stream mode (so
+# no member list is built, and there's no seeking back in a compressed
+# archive), for .cygport files and .sh build scripts
+#
+# returns lists of (name, content) for each, although only the content of the
+# member which might be needed is read (the first .cygport, or the first .sh if
+# no .cygport has been seen), and stops as soon as the answer is known (when a
+# second .cygport is seen, as that's an error)
+#
+
+def scan_srcpkg(srcpkg):
+    cygports = []
+    scripts = []
+
+    with tarfile.open(srcpkg, mode='r|*') as tf:
+        for m in tf:
+            if re.search(r'\.cygport$', m.name):
+                content = None
+                if not cygports:
+                    content = _read_member(tf, m)
+                cygports.append((m.name, content))
+
+                if len(cygports) > 1:
+                    break
+            elif re.search(r'\.sh$', m.name):
+                content = None
+                if not cygports and not scripts:
+                    content = _read_member(tf, m)
+                scripts.append((m.name, content))
+
+    return (cygports, scripts)
+
+
+def _read_member(tf, m):
+    f = tf.extractfile(m)
+    if f is None:
+        return b''
+    return f.read()
+
 #
 # guess at build depends, by looking at setup.hints
 #
 
-pkg_to_devel_pkg_map = eval(open('devel_package_map').read())
+pkg_to_devel_pkg_map = MapIndex('devel_package_map')
 
 def depends_from_hints(srcpkg, indir):
     runtime_deps = set()
@@ -243,7 +384,8 @@ def depends_from_cygport(content):
 # look up build depends in a list we keep
 #
 
-per_package_deps = eval(open('per-package-deps').read())
+per_package_deps = eval(open(os.path.join(mapindex.basedir, 'per-package-deps')).read())
+per_package_matcher = RuleMatcher(per_package_deps)
 
 def depends_from_hardcoded(srcpkg, indir):
     build_deps = set()
@@ -251,9 +393,8 @@ def depends_from_hardcoded(srcpkg, indir):
     p = os.path.split(indir)[1]
 
     # if regex matches package name, add the listed deps
-    for i in per_package_deps:
-        if re.match(i, p):
-            build_deps.update(per_package_deps[i])
+    for deps in per_package_matcher.match(p):
+        build_deps.update(deps)
 
     # XXX: force gettext-devel to be installed, as cygport currently has a bug
     # which causes it to silently exit if it's not present...
@@ -266,7 +407,7 @@ def depends_from_hardcoded(srcpkg, indir):
 # transform a cygport DEPEND atom list into a list of cygwin packages
 #
 
-pkgconfig_map = eval(open('pkgconfig-map').read())
+pkgconfig_map = MapIndex('pkgconfig-map')
 
 def depends_from_depend(depend):
     build_deps = set()
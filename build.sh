@@ -4,8 +4,8 @@
 #
 # given a src package, this will
 #
-# - unpack the src packagez
 # - install it's build-deps
+# - unpack the src packagez
 # - build the package
 # - copy the built dist files into OUTDIR
 #
@@ -32,11 +32,6 @@ SETUP_ARCH=${ARCH/i686/x86}
 # note the amount of free space
 AVAIL_INITIAL=$(df --output=avail / | sed 1d)
 
-# unpack the src package into work directory
-rm -rf ${BUILDDIR}
-mkdir ${BUILDDIR}
-tar -C ${BUILDDIR} -xvf ${SRCPKG} || exit 1
-
 # install the build dependencies
 if [ -f depends ] ; then
     DEPEND=$(cat depends)
@@ -57,6 +52,16 @@ if [ -n "${DEPEND}" ] ; then
     source /etc/profile
 fi
 
+# when preparing a dependency layer, that's all
+if [ "${KIND}" = "depends-only" ] ; then
+    exit 0
+fi
+
+# unpack the src package into work directory
+rm -rf ${BUILDDIR}
+mkdir ${BUILDDIR}
+tar -C ${BUILDDIR} -xvf ${SRCPKG} || exit 1
+
 # move to the directory containing the build script
 cd ${BUILDDIR}
 cd $(dirname ${SCRIPT})
@@ -98,6 +103,14 @@ cd ${OUTDIR}
 find * -type f >manifest
 cat manifest
 
+# write the size and SHA-256 of each build product, so the host can tell which
+# ones it needs to fetch
+while read f ; do
+    if [ "$f" != "manifest" ] ; then
+        echo "$(sha256sum -b "$f" | cut -d' ' -f1) $(stat -c %s "$f") $f"
+    fi
+done <manifest >digests
+
 # compute used disk space
 AVAIL_FINAL=$(df --output=avail / | sed 1d)
 echo "free space: initial ${AVAIL_INITIAL}, final ${AVAIL_FINAL}, delta $((${AVAIL_INITIAL}-${AVAIL_FINAL})) blocks"
@@ -21,14 +21,24 @@
 # THE SOFTWARE.
 #
 
+from collections import namedtuple
+from lxml import etree
 import os
 import logging
 import libvirt
+import queue
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
 import time
 
-from libvirt_qemu_ga_utils import guestFileCopyFrom, guestFileCopyTo, guestFileRead, guestFileWrite, guestExec, guestPing
-from clone import clone
-import steptimer
+from libvirt_qemu_ga_utils import guestFileCopyFrom, guestFileCopyTo, guestFileRead, guestFileReadInto, guestFileWrite, guestExec, guestForget, guestPing, guestSetChunkSizeKey, guestSetTime
+from clone import clone, restore_clone
+from steptimer import StepTimer
+import verify
+import virtconn
 
 #
 debug = False
@@ -44,6 +54,44 @@ BASE_VMID = {
     'noarch': 'virtio',
 }
 
+# the number of already booted VMs to keep ready for each arch, when a pool is
+# in use
+POOL_SIZE = {
+    'x86_64': 2,
+    'x86':    1,
+    'noarch': 0,
+}
+
+# the disk space which dependency layers may use, and how long they are used
+# for before being recreated (to pick up newer versions of the dependencies),
+# when dependency layers are in use
+LAYER_BUDGET = 64*1024*1024*1024
+LAYER_MAX_AGE = 7*24*60*60
+
+# resume VMs from a saved memory state, rather than booting them from scratch
+resume = False
+
+# the number of saved states to keep for each base VM image.  Only one VM can
+# be resumed from each saved state at a time, so this limits how many VMs can
+# be resumed concurrently, beyond which we fall back to booting
+RESUME_SLOTS = 8
+
+# how build inputs and outputs are moved to and from the VM: 'agent' (through
+# the guest agent file API) or 'disk' (on attached disk images)
+transport = 'agent'
+
+# fetch the build products as a single archive, rather than file by file (when
+# using the guest agent transport)
+bulk_fetch = True
+
+# size of the scratch disk image for build products (when using the disk
+# transport).  This is created sparse, so only the space actually used is
+# consumed.
+OUT_IMAGE_SIZE = 16*1024*1024*1024
+
+# the longest a build may take before it's killed
+BUILD_TIMEOUT = 12*60*60
+
 # path to bash, for each arch
 bash_path = {
     'x86_64': r'C:\\cygwin64\\bin\\bash.exe',
@@ -52,125 +100,579 @@ bash_path = {
 }
 
 #
-# clone a fresh VM, build the given |srcpkg| in it, retrieve the build products
-# to |outdir|, and discard the VM
+# a running build VM
 #
 
-def build(srcpkg, outdir, package, jobid, logfile, arch):
-    logging.info('building %s to %s' % (os.path.basename(srcpkg), outdir))
+BuildVM = namedtuple('BuildVM', 'vmid domain storage slot', defaults=(None,))
+
+#
+# clone a fresh VM for |arch| as |vmid| (from the dependency layer disk image
+# |layer|, if given), and boot it up (or resume it from a saved state) until the
+# guest agent is responsive
+#
+# (the steps are timed by |timer|, if given)
+#
 
-    steptimer.start()
-    vmid = 'buildvm_%d' % jobid
+def start_vm(conn, arch, vmid, layer=None, timer=None):
+    if timer is None:
+        timer = StepTimer()
 
-    # open a libvirt connection to hypervisor
-    libvirt.virInitialize()
-    libvirt.virEventRegisterDefaultImpl()
-    conn = libvirt.open('qemu:///system')
-    if conn == None:
-        logging.error('Failed to open connection to the hypervisor')
-        return False
+    if resume and not layer:
+        result = resume_vm(conn, arch, vmid, timer)
+        if result:
+            vm, responsive = result
+            if responsive:
+                return result
+
+            # boot instead
+            logging.warning('guest agent not responding in resumed VM %s, discarding it and booting' % (vm.vmid))
+            destroy_vm(vm)
 
     # create VM
-    clone_storage = clone(conn, BASE_VMID[arch], vmid)
-    steptimer.mark('clone vm')
+    clone_storage = clone(conn, BASE_VMID[arch], vmid, layer)
+    timer.mark('clone vm')
 
     domain = conn.lookupByName(vmid)
+    guestSetChunkSizeKey(domain, BASE_VMID[arch])
 
-    # start vm, automatically clean up when we are done, unless debugging
-    domain.createWithFlags(libvirt.VIR_DOMAIN_START_AUTODESTROY if not debug else 0)
+    # start vm, automatically clean up when we are done, unless debugging, and
+    # wait for it to boot up
+    boot_vm(domain, libvirt.VIR_DOMAIN_START_AUTODESTROY if not debug else 0)
+    responsive = guestPing(domain)
 
-    # wait for vm to boot up
-    wait_for_guest_agent(conn, domain, 5*60)
-    guestPing(domain)
+    timer.mark('boot')
 
-    steptimer.mark('boot')
+    return BuildVM(vmid, domain, clone_storage), responsive
 
-    # ensure directory exists and is empty
-    guestExec(domain, 'cmd', ['/C', 'rmdir', '/S', '/Q', r'C:\\vm_in\\'])
-    guestExec(domain, 'cmd', ['/C', 'mkdir', r'C:\\vm_in\\'])
+#
+# the disk image file of |domain|
+#
 
-    # install build instructions and source
-    for f in ['build.sh', 'wrapper.sh', srcpkg]:
-        guestFileCopyTo(domain, f, r'C:\\vm_in\\' + os.path.basename(f))
+def disk_image(domain):
+    tree = etree.fromstring(domain.XMLDesc(0))
+    return tree.xpath("/domain/devices/disk[@device='disk']/source")[0].get('file')
 
-    if package.depends:
-        guestFileWrite(domain, r'C:\\vm_in\\depends', bytes(package.depends, 'ascii'))
+#
+# the disk image file of the base VM for |arch|
+#
 
-    steptimer.mark('put')
+def base_image(arch):
+    base = virtconn.connection().lookupByName(BASE_VMID[arch])
+    return disk_image(base)
 
-    # attempt the build
-    success = guestExec(domain, bash_path[arch], ['-l','/cygdrive/c/vm_in/wrapper.sh', os.path.basename(srcpkg), r'C:\\vm_out', package.script, package.kind])
-    steptimer.mark('build')
+#
+# discard a VM
+#
 
-    # XXX: guest-agent doesn't seem to be capable of capturing output of cygwin
-    # process (for some strange reason), so we arrange to redirect it to a file
-    # and collect it here...
-    guestFileCopyFrom(domain, r'C:\\vm_in\\output', logfile)
-    logging.info('build logfile is %s' % (logfile))
+def destroy_vm(vm):
+    # terminate the VM.  Don't bother giving it a chance to shut down cleanly
+    # since we won't be using it again
+    guestForget(vm.domain)
+    try:
+        vm.domain.destroy()
 
-    # if the build was successful, fetch build products from VM
-    if success:
-        os.makedirs(outdir, exist_ok=True)
-        manifest = os.path.join(outdir, 'manifest')
-        guestFileCopyFrom(domain, r'C:\\vm_out\\manifest', manifest)
+        # clean up VM
+        if vm.domain.isPersistent():
+            vm.domain.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_MANAGED_SAVE |
+                                    libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA |
+                                    libvirt.VIR_DOMAIN_UNDEFINE_NVRAM)
+        os.remove(vm.storage)
+    finally:
+        if vm.slot:
+            _resume_slot_release(*vm.slot)
 
-        with open(manifest) as f:
-            for l in f:
-                l = l.strip()
-                fn = os.path.join(outdir, l)
-                os.makedirs(os.path.dirname(fn), exist_ok=True)
-                winpath = l.replace('/',r'\\')
-                guestFileCopyFrom(domain, r'C:\\vm_out\\' + winpath, fn)
+#
+# saved states to resume VMs from
+#
+# Each slot for a base VM image is a domain <base>_resume_<n>, which was booted
+# once (on a thin clone of the base image) until the guest agent was responsive
+# and cygwin had been started, then had it's state saved and it's disk image
+# made read-only.  Each VM resumed from that slot gets a thin clone of that disk
+# image.
+#
 
-    steptimer.mark('fetch')
+_resume_lock = threading.Lock()
+_resume_slots = {}
 
-    if not debug:
-        # terminate the VM.  Don't bother giving it a chance to shut down
-        # cleanly since we won't be using it again
-        domain.destroy()
+def _resume_slot_lease(base_id):
+    with _resume_lock:
+        if base_id not in _resume_slots:
+            _resume_slots[base_id] = queue.Queue()
+            for i in range(0, RESUME_SLOTS):
+                _resume_slots[base_id].put(i)
 
-        # clean up VM
+    try:
+        return _resume_slots[base_id].get_nowait()
+    except queue.Empty:
+        return None
+
+
+def _resume_slot_release(base_id, slot):
+    _resume_slots[base_id].put(slot)
+
+
+def _resume_slot_paths(conn, base_id, slot):
+    saved_id = '%s_resume_%d' % (base_id, slot)
+    base_file = disk_image(conn.lookupByName(base_id))
+
+    saved_storage = os.path.join(os.path.dirname(base_file), saved_id + '.qcow2')
+    state_file = os.path.join(os.path.dirname(base_file), saved_id + '.save')
+
+    return saved_id, base_file, saved_storage, state_file
+
+#
+# boot a VM for |arch| in resume slot |slot| and save it's state
+#
+
+def capture_vm_state(conn, arch, slot):
+    base_id = BASE_VMID[arch]
+    saved_id, base_file, saved_storage, state_file = _resume_slot_paths(conn, base_id, slot)
+    logging.info('capturing saved state %s' % (state_file))
+
+    for f in [saved_storage, state_file]:
+        if os.path.exists(f):
+            os.remove(f)
+
+    clone(conn, base_id, saved_id)
+    domain = conn.lookupByName(saved_id)
+
+    try:
+        boot_vm(domain, 0)
+
+        # run a login shell once, so cygwin is started and idle
+        if not guestPing(domain) or not guestExec(domain, bash_path[arch], ['-l', '-c', 'true']):
+            logging.error('guest agent not responsive while capturing saved state %s' % (state_file))
+            domain.destroy()
+            os.remove(saved_storage)
+            return False
+
+        domain.save(state_file)
+    finally:
         domain.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_MANAGED_SAVE |
                              libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA |
                              libvirt.VIR_DOMAIN_UNDEFINE_NVRAM)
-        os.remove(clone_storage)
-        steptimer.mark('destroy vm')
+
+    # the disk image must not change after the state is saved
+    os.chmod(saved_storage, 0o444)
+
+    return True
+
+#
+# resume a VM for |arch| from a saved state, capturing the saved state first if
+# needed.  Returns None if no saved state slot is available.
+#
+
+def resume_vm(conn, arch, vmid, timer):
+    base_id = BASE_VMID[arch]
+    slot = _resume_slot_lease(base_id)
+    if slot is None:
+        logging.info('no saved state available to resume %s from, booting' % (base_id))
+        return None
+
+    try:
+        saved_id, base_file, saved_storage, state_file = _resume_slot_paths(conn, base_id, slot)
+
+        # (re)capture the saved state if it's missing or out of date
+        if not os.path.exists(state_file) or (os.path.getmtime(state_file) < os.path.getmtime(base_file)):
+            if not capture_vm_state(conn, arch, slot):
+                _resume_slot_release(base_id, slot)
+                return None
+
+        clone_storage = os.path.join(os.path.dirname(saved_storage), vmid + '.qcow2')
+        domain = conn.lookupByName(restore_clone(conn, state_file, clone_storage))
+        guestSetChunkSizeKey(domain, base_id)
+        timer.mark('clone vm')
+    except:
+        _resume_slot_release(base_id, slot)
+        raise
+
+    # the guest agent connection may take a moment to come back after resuming
+    responsive = False
+    for i in range(0, 10):
+        if guestPing(domain):
+            responsive = True
+            break
+        time.sleep(0.5)
+
+    # the guest's clock will be behind by however long ago the state was saved
+    guestSetTime(domain)
+    timer.mark('resume')
+
+    logging.info('resumed %s from %s' % (domain.name(), state_file))
+    return BuildVM(domain.name(), domain, clone_storage, (base_id, slot)), responsive
+
+#
+# clone a fresh VM (from a disk image in |layers| with the dependencies already
+# installed, if there is one, otherwise take an already booted one from |pool|,
+# if there is one ready), build the given |srcpkg| in it, retrieve the build
+# products to |outdir| (except those with the same digests as the |known| files,
+# relative to |outdir|), and discard the VM
+#
+# (the steps are timed by |timer|, if given)
+#
+
+def build(srcpkg, outdir, package, jobid, logfile, arch, pool=None, layers=None, known=None, timer=None):
+    logging.info('building %s to %s' % (os.path.basename(srcpkg), outdir))
+
+    if timer is None:
+        timer = StepTimer()
+
+    depends = package.depends
+    layer = None
+    if layers and depends:
+        layer = layers.get(arch, depends)
+
+    # whatever happens, release the layer, and discard the VM (and so release
+    # it's resume slot, if it has one), unless debugging (in which case the VM
+    # is kept to be looked at)
+    vm = None
+    try:
+        if pool and not layer:
+            vm = pool.get(arch)
+
+        if vm:
+            logging.info('using pooled VM %s' % (vm.vmid))
+            timer.mark('pool')
+        else:
+            # get a libvirt connection to hypervisor
+            try:
+                conn = virtconn.connection()
+            except libvirt.libvirtError:
+                logging.exception('Failed to open connection to the hypervisor')
+                return False
+
+            vm, responsive = start_vm(conn, arch, 'buildvm_%d' % jobid, layer, timer)
+            if not responsive:
+                logging.error('guest agent not responding in %s' % (vm.vmid))
+                return False
+
+        domain = vm.domain
+
+        # the dependencies are already installed in the layer
+        if layer:
+            depends = ''
+
+        # install build instructions and source
+        tr = TRANSPORTS[transport](vm, arch)
+        put = tr.put(['build.sh', 'wrapper.sh', srcpkg], depends)
+        timer.mark('put')
+
+        # attempt the build
+        success = False
+        if put:
+            success = guestExec(domain, bash_path[arch], ['-l','/cygdrive/c/vm_in/wrapper.sh', os.path.basename(srcpkg), r'C:\\vm_out', package.script, package.kind], timeout=BUILD_TIMEOUT)
+        timer.mark('build')
+
+        # fetch build log, and build products if the build was successful
+        tr.fetch(logfile, outdir, success, known)
+        timer.mark('fetch')
+    finally:
+        if vm and not debug:
+            try:
+                destroy_vm(vm)
+            except (libvirt.libvirtError, OSError):
+                logging.exception('failed to destroy %s' % (vm.vmid))
+            timer.mark('destroy vm')
+
+        if layer:
+            layers.release(layer)
+
+    tr.collect(logfile, outdir, success)
+    timer.mark('collect')
+    logging.info('build logfile is %s' % (logfile))
 
     status = 'succeeded' if success else 'failed'
-    logging.info('build %s, %s' % (status, steptimer.report()))
+    logging.info('build %s, %s' % (status, timer.report()))
 
     return success
 
 #
-# wait for the VM to start up and get into a state where guest-agent can
-# respond
+# transports for build inputs and outputs
+#
+# put() installs the files listed, and a 'depends' file containing |depends|,
+# into C:\vm_in, fetch() retrieves the build log (and build products if the
+# build succeeded) while the VM is still running, and collect() does anything
+# which needs to be done after the VM has been discarded.
+#
+
+#
+# copy files through the guest agent file API
+#
+
+class AgentTransport:
+    def __init__(self, vm, arch):
+        self.vm = vm
+        self.arch = arch
+
+    def put(self, files, depends):
+        domain = self.vm.domain
+
+        # ensure directory exists and is empty
+        guestExec(domain, 'cmd', ['/C', 'rmdir', '/S', '/Q', r'C:\\vm_in\\'])
+        guestExec(domain, 'cmd', ['/C', 'mkdir', r'C:\\vm_in\\'])
+
+        for f in files:
+            guestFileCopyTo(domain, f, r'C:\\vm_in\\' + os.path.basename(f))
+
+        if depends:
+            guestFileWrite(domain, r'C:\\vm_in\\depends', bytes(depends, 'ascii'))
+
+        return True
+
+    def fetch(self, logfile, outdir, success, known=None):
+        domain = self.vm.domain
+
+        # XXX: guest-agent doesn't seem to be capable of capturing output of
+        # cygwin process (for some strange reason), so we arrange to redirect
+        # it to a file and collect it here...
+        guestFileCopyFrom(domain, r'C:\\vm_in\\output', logfile)
+
+        if success:
+            os.makedirs(outdir, exist_ok=True)
+            manifest = os.path.join(outdir, 'manifest')
+            guestFileCopyFrom(domain, r'C:\\vm_out\\manifest', manifest)
+            with open(manifest) as f:
+                wanted = [l.strip() for l in f if l.strip() != 'manifest']
+
+            # don't fetch products which are identical to |known| files (as
+            # verify() can tell that from the digests)
+            digests = os.path.join(outdir, 'digests')
+            if known:
+                if guestFileCopyFrom(domain, r'C:\\vm_out\\digests', digests):
+                    built = verify.read_digests(digests)
+                    products = len(wanted)
+                    wanted = [l for l in wanted if (l not in built) or (built[l] != known.get(l))]
+                    logging.info('fetching %d of %d build products, the rest are identical to the upload' % (len(wanted), products))
+                elif os.path.exists(digests):
+                    os.remove(digests)
+
+            if not wanted:
+                return
+
+            if not (bulk_fetch and fetch_archive(domain, self.arch, outdir, wanted)):
+                for l in wanted:
+                    fn = os.path.join(outdir, l)
+                    os.makedirs(os.path.dirname(fn), exist_ok=True)
+                    winpath = l.replace('/',r'\\')
+                    guestFileCopyFrom(domain, r'C:\\vm_out\\' + winpath, fn)
+
+    def collect(self, logfile, outdir, success):
+        pass
+
+#
+# build a FAT disk image on the host containing the build inputs, and attach
+# it to the VM, along with an empty FAT scratch disk image.  In the guest, the
+# inputs are copied to C:\vm_in, and build outputs are copied to the scratch
+# disk, which is read on the host after the VM has been discarded.
+#
+# The images are built and read using mtools, so no privileges are needed for
+# loop mounting.  Each image contains a marker file, so the guest can find which
+# drive letter it has been given.
+#
+
+IN_MARKER = '.carpetbag_in'
+OUT_MARKER = '.carpetbag_out'
+
+def make_fat_image(path, size, label, files=[]):
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+    subprocess.check_call(['mformat', '-i', path, '-F', '-h', '64', '-s', '32', '-T', str(size // 512), '-v', label, '::'])
+    if files:
+        subprocess.check_call(['mcopy', '-i', path] + files + ['::/'])
+
+
+class DiskTransport:
+    def __init__(self, vm, arch):
+        self.vm = vm
+        self.arch = arch
+        self.in_image = os.path.splitext(vm.storage)[0] + '_in.img'
+        self.out_image = os.path.splitext(vm.storage)[0] + '_out.img'
+
+    def put(self, files, depends):
+        # build the input image
+        tmpdir = tempfile.mkdtemp(prefix='carpetbag_in_')
+        try:
+            extra = [os.path.join(tmpdir, IN_MARKER)]
+            open(extra[0], 'w').close()
+
+            if depends:
+                extra.append(os.path.join(tmpdir, 'depends'))
+                with open(extra[-1], 'w') as f:
+                    f.write(depends)
+
+            size = sum([os.path.getsize(f) for f in files]) + 64*1024*1024
+            make_fat_image(self.in_image, size, 'VM_IN', files + extra)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        # build the (empty) output image
+        with tempfile.TemporaryDirectory(prefix='carpetbag_out_') as tmpdir:
+            marker = os.path.join(tmpdir, OUT_MARKER)
+            open(marker, 'w').close()
+            make_fat_image(self.out_image, OUT_IMAGE_SIZE, 'VM_OUT', [marker])
+
+        self._attach(self.in_image, True)
+        self._attach(self.out_image, False)
+
+        return self._guest_copy_in()
+
+    def fetch(self, logfile, outdir, success, known=None):
+        self._guest_copy_out(success)
+
+    def collect(self, logfile, outdir, success):
+        subprocess.call(['mcopy', '-n', '-i', self.out_image, '::/output', logfile])
+
+        if success:
+            os.makedirs(outdir, exist_ok=True)
+            subprocess.call(['mcopy', '-s', '-n', '-i', self.out_image, '::/vm_out/*', outdir + '/'])
+
+        if not debug:
+            for f in [self.in_image, self.out_image]:
+                os.remove(f)
+
+    # attach a disk image to the running VM, using the next unused virtio disk
+    # name
+    def _attach(self, path, readonly):
+        tree = etree.fromstring(self.vm.domain.XMLDesc(0))
+        used = tree.xpath('/domain/devices/disk/target/@dev')
+        dev = next('vd' + c for c in 'bcdefghijklmnopqrstuvwxyz' if ('vd' + c) not in used)
+
+        self.vm.domain.attachDeviceFlags('''<disk type='file' device='disk'>
+<driver name='qemu' type='raw'/>
+<source file='%s'/>
+<target dev='%s' bus='virtio'/>
+%s
+</disk>''' % (path, dev, '<readonly/>' if readonly else ''), libvirt.VIR_DOMAIN_AFFECT_LIVE)
+
+    # (these scripts are passed in a json string by guestExec, so can't contain
+    # quotes or backslashes)
+
+    # wait for the input disk to appear, and copy it's contents to C:\vm_in
+    def _guest_copy_in(self):
+        script = ('for i in $(seq 60) ; do for d in /cygdrive/* ; do if [ -f $d/%s ] ; then '
+                  'rm -rf /cygdrive/c/vm_in && cp -r $d /cygdrive/c/vm_in && exit 0 ; '
+                  'exit 1 ; fi ; done ; sleep 1 ; done ; exit 1' % (IN_MARKER))
+        return guestExec(self.vm.domain, bash_path[self.arch], ['-l', '-c', script])
+
+    # copy the build log, and build products, to the output disk and flush it
+    def _guest_copy_out(self, success):
+        products = 'cp -r /cygdrive/c/vm_out $d/vm_out ; ' if success else ''
+        script = ('for d in /cygdrive/* ; do if [ -f $d/%s ] ; then '
+                  'cp /cygdrive/c/vm_in/output $d/output ; %s'
+                  'sync ; exit 0 ; fi ; done ; exit 1' % (OUT_MARKER, products))
+        return guestExec(self.vm.domain, bash_path[self.arch], ['-l', '-c', script])
+
+
+TRANSPORTS = {
+    'agent': AgentTransport,
+    'disk': DiskTransport,
+}
+
+#
+# fetch the build products listed in the manifest as a single archive, which is
+# unpacked into |outdir| as it arrives
+#
+
+def fetch_archive(domain, arch, outdir, wanted):
+    guestFileWrite(domain, r'C:\\vm_out.wanted', bytes(''.join([l + '\n' for l in wanted]), 'utf-8'))
+
+    # the build products are mostly compressed already, so the archive isn't
+    # compressed
+    if not guestExec(domain, bash_path[arch], ['-l', '-c', 'cd /cygdrive/c/vm_out && tar -cf /cygdrive/c/vm_out.tar -T /cygdrive/c/vm_out.wanted']):
+        logging.warning('packing build products failed, fetching them individually')
+        return False
+
+    (r, w) = os.pipe()
+    with open(r, 'rb') as rf:
+        def writer():
+            with open(w, 'wb') as wf:
+                try:
+                    writer.result = guestFileReadInto(domain, r'C:\\vm_out.tar', wf)
+                except BrokenPipeError:
+                    # unpacking stopped early
+                    writer.result = False
+
+        writer.result = False
+        t = threading.Thread(target=writer)
+        t.start()
+
+        try:
+            with tarfile.open(fileobj=rf, mode='r|') as tf:
+                for m in tf:
+                    # only expect plain files with relative paths
+                    if not m.isfile() or os.path.isabs(m.name) or '..' in m.name.split('/'):
+                        logging.error('unexpected member %s in build products archive' % (m.name))
+                        return False
+                    tf.extract(m, outdir, set_attrs=False)
+        except tarfile.TarError:
+            logging.exception('unpacking build products failed')
+            return False
+        finally:
+            rf.close()
+            t.join()
+
+    return writer.result
+
+#
+# start the VM and wait for it to get into a state where guest-agent can respond
 #
 # sometimes the guest agent seems to break and not start properly, so have a
 # timeout to deal with that case...
 #
-# (XXX: really this is a bit inside-out; this module might be better rewritten
-# as a state machine which responds to events from the domain)
+
+BOOT_TIMEOUT = 5*60
+
+def boot_vm(domain, flags):
+    # (register for the event before starting, so it can't be missed)
+    connected = virtconn.agent_connected(domain, BOOT_TIMEOUT)
+    domain.createWithFlags(flags)
+    return connected.result()
+
+#
+# exercise the disk transport against a local stand-in for the guest, which
+# copies files between the images and a local directory (standing in for C:)
+# using mtools
 #
 
-def wait_for_guest_agent(conn, domain, timeout):
-    done = False
+if __name__ == "__main__":
+    import filecmp
+
+    logging.basicConfig(level=logging.INFO)
+    debug = False
+
+    class StandInDiskTransport(DiskTransport):
+        def _attach(self, path, readonly):
+            pass
+
+        def _guest_copy_in(self):
+            os.makedirs(os.path.join(drive_c, 'vm_in'))
+            return subprocess.call(['mcopy', '-s', '-n', '-i', self.in_image, '::/*', os.path.join(drive_c, 'vm_in') + '/']) == 0
 
-    def timeoutEventCallback(timer, opaque):
-        logging.info("timeout event:")
-        nonlocal done
-        done = True
+        def _guest_copy_out(self, success):
+            # pretend to build
+            vm_in = os.path.join(drive_c, 'vm_in')
+            with open(os.path.join(vm_in, 'output'), 'w') as f:
+                f.write('build log\n')
+            product = os.path.join(drive_c, 'vm_out', 'foo', 'foo-1.0-1.tar.xz')
+            os.makedirs(os.path.dirname(product))
+            shutil.copy(os.path.join(vm_in, 'build.sh'), product)
 
-    def domainEventAgentLifecycleCallback (conn, dom, state, reason, opaque):
-        logging.info("agentLifecycle event: domain '%s' state %d reason %d" % (dom.name(), state, reason))
-        if state == libvirt.VIR_CONNECT_DOMAIN_EVENT_AGENT_LIFECYCLE_STATE_CONNECTED:
-            nonlocal done
-            done = True
+            subprocess.check_call(['mcopy', '-i', self.out_image, os.path.join(vm_in, 'output'), '::/'])
+            subprocess.check_call(['mcopy', '-s', '-i', self.out_image, os.path.join(drive_c, 'vm_out'), '::/'])
 
-    timer_id = libvirt.virEventAddTimeout(timeout*1000, timeoutEventCallback, None)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        drive_c = os.path.join(tmpdir, 'c')
+        OUT_IMAGE_SIZE = 64*1024*1024
 
-    conn.domainEventRegisterAny(domain, libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE, domainEventAgentLifecycleCallback, None)
+        tr = StandInDiskTransport(BuildVM('standin', None, os.path.join(tmpdir, 'standin.qcow2')), 'x86_64')
+        assert tr.put(['build.sh', 'wrapper.sh'], 'gettext-devel')
+        assert open(os.path.join(drive_c, 'vm_in', 'depends')).read() == 'gettext-devel'
+        assert os.path.exists(os.path.join(drive_c, 'vm_in', IN_MARKER))
 
-    while not done:
-        libvirt.virEventRunDefaultImpl()
+        tr.fetch(os.path.join(tmpdir, 'log'), os.path.join(tmpdir, 'out'), True)
+        tr.collect(os.path.join(tmpdir, 'log'), os.path.join(tmpdir, 'out'), True)
+        assert open(os.path.join(tmpdir, 'log')).read() == 'build log\n'
+        assert filecmp.cmp('build.sh', os.path.join(tmpdir, 'out', 'foo', 'foo-1.0-1.tar.xz'), shallow=False)
 
-    libvirt.virEventRemoveTimeout(timer_id)
+        print('disk transport ok')
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Jon Turney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+#
+# Pieces shared by the persistent caches
+#
+# The caches are keyed by digests of their inputs, which include the content of
+# files.
+#
+# The dependency layer and build result caches keep files (or directories) on
+# disk, with a row for each in a table in the database, and evict them least
+# recently used first when their total size exceeds a disk budget, or when they
+# are too old.
+#
+
+import logging
+import sqlite3
+import threading
+import time
+
+#
+# update the hash |h| with the content of the file |fn|
+#
+
+def hash_file(h, fn):
+    with open(fn, 'rb') as f:
+        while True:
+            b = f.read(1024*1024)
+            if not b:
+                break
+            h.update(b)
+
+#
+# a cache of files (described as |description| in log messages), kept in the
+# database table |table|, which has the columns |columns| (which must include
+# key, path, size, created and last_used)
+#
+# Subclasses must implement _remove(), and may implement _in_use() (for
+# entries which can't be evicted right now).
+#
+
+class LRUCache:
+    description = 'cache entry'
+
+    def __init__(self, dbpath, table, columns, budget, max_age):
+        self.table = table
+        self.budget = budget
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(dbpath, check_same_thread=False, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (table, columns))
+        self.conn.commit()
+
+    # look up the entry for |key| (with the lock held), returning it's path and
+    # the other |columns| requested, or None if there isn't one, or it has
+    # expired (in which case it's evicted)
+    def _lookup(self, key, columns=[]):
+        row = self.conn.execute('SELECT created, %s FROM %s WHERE key = ?' % (', '.join(['path'] + columns), self.table), (key,)).fetchone()
+        if row and (row[0] + self.max_age < time.time()):
+            logging.info('%s %s has expired' % (self.description, row[1]))
+            self._evict(key, row[1])
+            row = None
+
+        if not row:
+            return None
+
+        self.conn.execute('UPDATE %s SET last_used = ? WHERE key = ?' % (self.table), (time.time(), key))
+        self.conn.commit()
+        return row[1:]
+
+    # remove the files of an entry
+    def _remove(self, path):
+        raise NotImplementedError
+
+    # if the entry at |path| is in use, so can't be evicted
+    def _in_use(self, path):
+        return False
+
+    # remove an entry (with the lock held)
+    def _evict(self, key, path):
+        logging.info('evicting %s %s' % (self.description, path))
+        self._remove(path)
+        self.conn.execute('DELETE FROM %s WHERE key = ?' % (self.table), (key,))
+        self.conn.commit()
+
+    # evict least recently used entries, which aren't in use, until we are
+    # within budget (with the lock held)
+    def _trim(self):
+        total = self.conn.execute('SELECT SUM(size) FROM %s' % (self.table)).fetchone()[0] or 0
+        for key, path, size in list(self.conn.execute('SELECT key, path, size FROM %s ORDER BY last_used' % (self.table))):
+            if total <= self.budget:
+                break
+            if self._in_use(path):
+                continue
+            self._evict(key, path)
+            total -= size
@@ -36,14 +36,19 @@ import uuid
 # qcow2 disk image linked to the base disk image, to avoid copying it.
 # Obviously, this can't work if the underlying disk image isn't qcow2.
 #
-# Ideally we would also resume from a paused state, rather than boot the VM from
-# scratch...   I'm not sure of the best way to do that with libvirt.
+# We can also resume from a saved state, rather than boot the VM from scratch,
+# see restore_clone() below.
 #
 # some bits based on modify-domain.py from
 # http://www.greenhills.co.uk/2013/03/24/cloning-vms-with-kvm.html
 #
 
-def clone(conn, base_id, clone_id):
+#
+# If |base_file| is given, the clone's disk image is linked to that, rather
+# than the base VM's disk image (which it should be derived from).
+#
+
+def clone(conn, base_id, clone_id, base_file=None):
     # get the XML description of the base_id VM
     base = conn.lookupByName(base_id)
     xmldesc = base.XMLDesc(libvirt.VIR_DOMAIN_XML_SECURE)
@@ -63,7 +68,8 @@ def clone(conn, base_id, clone_id):
         raise Exception("base VM not using qcow2, don't know what to do")
 
     source_el = tree.xpath("/domain/devices/disk[@device='disk']/source")[0]
-    base_file = source_el.get('file')
+    if base_file is None:
+        base_file = source_el.get('file')
     clone_file = os.path.join(os.path.dirname(base_file), clone_id + '.qcow2')
 
     # check that base_file is be read-only, to ensure it isn't being written to
@@ -91,6 +97,38 @@ def clone(conn, base_id, clone_id):
     return clone_file
 
 
+#
+# Restore a clone from the saved memory state |state_file|, with a fresh thin
+# disk image |clone_file| linked to the disk image the saved state was captured
+# with (which must not be modified after the state was saved, so should be
+# read-only)
+#
+# The saved state fixes the name and uuid of the restored domain, so only one
+# clone can be restored from a given state file at a time.  The restored domain
+# is transient, so it goes away when it's destroyed.
+#
+
+def restore_clone(conn, state_file, clone_file):
+    xmldesc = conn.saveImageGetXMLDesc(state_file, libvirt.VIR_DOMAIN_XML_SECURE)
+    tree = etree.fromstring(xmldesc)
+
+    # only the disk image path is changed, since restoring requires the domain
+    # configuration to otherwise remain the same
+    source_el = tree.xpath("/domain/devices/disk[@device='disk']/source")[0]
+    base_file = source_el.get('file')
+
+    if os.stat(base_file).st_mode & stat.S_IWRITE:
+        raise Exception("saved VM image %s is writeable, too dangerous!" % (base_file))
+
+    os.system('qemu-img create -q -f qcow2 -b %s %s' % (base_file, clone_file))
+    source_el.set('file', clone_file)
+
+    conn.restoreFlags(state_file, etree.tostring(tree, encoding='unicode'),
+                      libvirt.VIR_DOMAIN_SAVE_RUNNING)
+
+    return tree.xpath('/domain/name')[0].text
+
+
 def declone(conn, clone_id):
     clone = conn.lookupByName(clone_id)
     clone.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_MANAGED_SAVE |
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Jon Turney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+#
+# A compiled matcher for a table of regex rules (like per-package-deps),
+# mapping a regex to a value, which finds the values of all the rules which
+# re.match() a name, in one lookup
+#
+# Most rules are just a literal name (e.g. r'^gcc$') or a literal prefix (e.g.
+# r'^perl-.*$'), so those are put in dicts, and looked up by the name, and each
+# prefix of the name, so the cost depends on the length of the name, not the
+# number of rules.
+#
+# The remaining rules are combined into a single regex, with each rule in a
+# lookahead which captures a named group if it matches, so the groups which
+# matched identify all the rules which matched.  (A rule which has groups of
+# it's own, which might be referred to by number, or which otherwise can't be
+# combined, is matched separately.)
+#
+
+import re
+
+_literal = r'[^.^$*+?{}\[\]\\|()]*'
+_exact_re = re.compile(r'^\^(' + _literal + r')\$$')
+_prefix_re = re.compile(r'^\^(' + _literal + r')(?:\.\*)?$|^\^(' + _literal + r')\.\*\$$')
+
+
+class RuleMatcher:
+    def __init__(self, rules):
+        self.values = []
+        self.exact = {}
+        self.prefix = {}
+        self.separate = []
+        combined = []
+
+        for (i, (pattern, value)) in enumerate(rules.items()):
+            self.values.append(value)
+
+            match = _exact_re.match(pattern)
+            if match:
+                self.exact.setdefault(match.group(1), []).append(i)
+                continue
+
+            match = _prefix_re.match(pattern)
+            if match:
+                p = match.group(1) if match.group(1) is not None else match.group(2)
+                self.prefix.setdefault(p, []).append(i)
+                continue
+
+            if re.compile(pattern).groups == 0:
+                combined.append((pattern, i))
+            else:
+                self.separate.append((re.compile(pattern), i))
+
+        self.combined = None
+        if combined:
+            try:
+                self.combined = re.compile(''.join(['(?:(?=(?P<r%d>%s)))?' % (i, p) for (p, i) in combined]))
+            except re.error:
+                # e.g. inline flags, which must be at the start of a pattern
+                self.separate.extend([(re.compile(p), i) for (p, i) in combined])
+
+    # return the values of all the rules which match |name|, in rule order
+    def match(self, name):
+        matched = set(self.exact.get(name, []))
+
+        for l in range(0, len(name) + 1):
+            matched.update(self.prefix.get(name[:l], []))
+
+        if self.combined:
+            m = self.combined.match(name)
+            matched.update([int(g[1:]) for (g, v) in m.groupdict().items() if v is not None])
+
+        for (r, i) in self.separate:
+            if r.match(name):
+                matched.add(i)
+
+        return [self.values[i] for i in sorted(matched)]
+
+
+#
+# microbenchmark: compare the cost of looking up a name by trying each rule in
+# turn, with the matcher, as the number of rules grows
+#
+
+if __name__ == "__main__":
+    import random
+    import string
+    import timeit
+
+    random.seed(0)
+
+    def name():
+        return ''.join(random.choice(string.ascii_lowercase) for i in range(0, random.randint(3, 12)))
+
+    # a mix of rules like those in per-package-deps
+    def rules(n):
+        r = {}
+        while len(r) < n:
+            k = random.random()
+            if k < 0.9:
+                r[r'^%s$' % name()] = ['dep']
+            elif k < 0.99:
+                r[r'^%s-.*$' % name()] = ['dep']
+            else:
+                r[r'^%s\d*\.\d*$' % name()] = ['dep']
+        return r
+
+    names = [name() for i in range(0, 100)]
+
+    print('%8s %12s %12s' % ('rules', 're.match', 'matcher'))
+    for n in [10, 100, 1000, 5000]:
+        table = rules(n)
+        matcher = RuleMatcher(table)
+
+        def naive():
+            for p in names:
+                [table[i] for i in table if re.match(i, p)]
+
+        def compiled():
+            for p in names:
+                matcher.match(p)
+
+        # check they agree
+        for p in names + [random.choice(list(table)).strip('^$').replace('.*', 'x').replace(r'\d*\.\d*', '1.2')]:
+            assert [table[i] for i in table if re.match(i, p)] == matcher.match(p)
+
+        t_naive = min(timeit.repeat(naive, number=1, repeat=3)) / len(names)
+        t_compiled = min(timeit.repeat(compiled, number=10, repeat=3)) / (10 * len(names))
+        print('%8d %10.1fus %10.1fus' % (n, t_naive * 1e6, t_compiled * 1e6))
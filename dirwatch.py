@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Jon Turney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+#
+# Watch a directory tree (like a dirq queue) for files being added
+#
+# This uses inotify (through ctypes, so there's no extra dependency), watching
+# the directory and each subdirectory (adding watches for new subdirectories as
+# they are created, as dirq does as time passes).  If inotify isn't available,
+# wait() just times out, so the caller falls back to polling.
+#
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import threading
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_ISDIR = 0x40000000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+
+_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+_EVENT = struct.Struct('iIII')
+
+
+class DirWatcher:
+    def __init__(self, path):
+        self.path = path
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.watches = {}
+        self.fd = None
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            fd = libc.inotify_init1(IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        except (OSError, AttributeError) as e:
+            logging.warning('inotify not available (%s), polling %s' % (e, path))
+            return
+
+        self.fd = fd
+        self._watch_tree(path)
+        threading.Thread(target=self._thread, name='dirwatch', daemon=True).start()
+
+    # wait until something is added, or |timeout| seconds pass, returning True
+    # in the first case
+    def wait(self, timeout):
+        changed = self.event.wait(timeout)
+        self.event.clear()
+        return changed
+
+    # wake any waiter, as if something was added
+    def notify(self):
+        self.event.set()
+
+    def _watch(self, path):
+        wd = self._add_watch(self.fd, os.fsencode(path), _MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e != errno.ENOENT:
+                logging.warning('failed to watch %s: %s' % (path, os.strerror(e)))
+            return
+        with self.lock:
+            self.watches[wd] = path
+
+    def _watch_tree(self, path):
+        self._watch(path)
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            for d in dirnames:
+                self._watch(os.path.join(dirpath, d))
+
+    def _thread(self):
+        while True:
+            buf = os.read(self.fd, 64*1024)
+            changed = False
+
+            offset = 0
+            while offset < len(buf):
+                (wd, mask, cookie, length) = _EVENT.unpack_from(buf, offset)
+                name = buf[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+                offset += _EVENT.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, so assume something changed
+                    changed = True
+                    continue
+
+                if mask & IN_IGNORED:
+                    with self.lock:
+                        self.watches.pop(wd, None)
+                    continue
+
+                with self.lock:
+                    parent = self.watches.get(wd)
+                if parent is None:
+                    continue
+
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        # watch the new subdirectory (and anything which was
+                        # put in it before the watch was added)
+                        self._watch_tree(os.path.join(parent, os.fsdecode(name)))
+                        changed = True
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    changed = True
+
+            if changed:
+                self.event.set()
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    logging.basicConfig(level=logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        w = DirWatcher(tmpdir)
+        assert not w.wait(0.1)
+
+        # a file written in a new subdirectory should be noticed
+        os.mkdir(os.path.join(tmpdir, 'sub'))
+        assert w.wait(1)
+        time.sleep(0.1)
+        w.wait(0)
+        with open(os.path.join(tmpdir, 'sub', 'item.tmp'), 'w') as f:
+            f.write('x')
+        os.rename(os.path.join(tmpdir, 'sub', 'item.tmp'), os.path.join(tmpdir, 'sub', 'item'))
+        assert w.wait(1)
+
+    print('ok')
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Jon Turney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+#
+# The jobs table
+#
+# The database is used in WAL mode, so the workers, the queue puller and
+# anything reading the job history don't block each other, and each thread has
+# it's own connection.  Job ids are allocated in the database, in the same
+# transaction as the jobs are inserted, and there are indexes so finding pending
+# jobs (and jobs by time) doesn't get slower as the history grows.
+#
+# Pending jobs are claimed shortest expected job first, so a few big builds
+# don't hold up lots of small ones.  A job's runtime is predicted from the
+# durations of the steps of recent builds of the same package (which are
+# recorded as each job finishes), or if it hasn't been built before, from the
+# size of the srcpkg.  The longer a job waits the more it's preferred, so big
+# jobs aren't starved.
+#
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# how many recent builds of a package to average to predict it's runtime
+PREDICT_HISTORY = 5
+# seconds per byte of srcpkg, used to predict the runtime from the srcpkg size
+# when there's no build history to estimate it from
+DEFAULT_RATE = 300/(1024*1024)
+# predicted runtime, when there's nothing to go on
+DEFAULT_PREDICTION = 600
+# seconds of predicted runtime forgiven for each second a job has been waiting
+AGING = 1.0
+
+
+# builds of the same package (for the same arch) are expected to take about as
+# long as each other
+def package(srcpkg):
+    return os.path.dirname(srcpkg)
+
+
+class JobStore:
+    def __init__(self, dbpath, jobid_file=None, aging=AGING):
+        self.dbpath = dbpath
+        self.aging = aging
+        self.local = threading.local()
+        self.added = threading.Condition()
+        self.generation = 0
+
+        conn = self.conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS jobs
+                        (id integer primary key, srcpkg text, status text, log text, buildlog text, built integer, valid integer, start_timestamp integer, end_timestamp integer, cached integer, force integer, size integer, queued_timestamp integer)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS steps
+                        (jobid integer, package text, step text, duration real, start_offset real, end_offset real)''')
+
+        # add any columns missing from a database created by an older version
+        columns = [r[1] for r in conn.execute('PRAGMA table_info(jobs)')]
+        for c in ['cached', 'force', 'size', 'queued_timestamp']:
+            if c not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN %s integer' % c)
+        columns = [r[1] for r in conn.execute('PRAGMA table_info(steps)')]
+        for c in ['start_offset', 'end_offset']:
+            if c not in columns:
+                conn.execute('ALTER TABLE steps ADD COLUMN %s real' % c)
+
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_start_timestamp ON jobs (start_timestamp)')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_end_timestamp ON jobs (end_timestamp)')
+        conn.execute('CREATE INDEX IF NOT EXISTS steps_jobid ON steps (jobid)')
+        conn.execute('CREATE INDEX IF NOT EXISTS steps_package ON steps (package, jobid)')
+        conn.commit()
+
+        # job ids used to be allocated from a file, so don't reuse any it
+        # handed out
+        self.seed = 0
+        if jobid_file:
+            try:
+                with open(jobid_file) as f:
+                    self.seed = int(f.read())
+            except (IOError, ValueError):
+                pass
+
+    # this thread's connection to the database
+    def conn(self):
+        if not hasattr(self.local, 'conn'):
+            conn = sqlite3.connect(self.dbpath, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return self.local.conn
+
+    # add a pending job for each srcpkg in |names| (with sizes in the
+    # corresponding element of |sizes|, if known), in one transaction,
+    # returning their job ids
+    def add(self, names, sizes=None):
+        if not names:
+            return []
+        if sizes is None:
+            sizes = [None] * len(names)
+
+        conn = self.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            last = conn.execute('SELECT MAX(id) FROM jobs').fetchone()[0] or 0
+            first = max(last, self.seed) + 1
+            ids = list(range(first, first + len(names)))
+            conn.executemany("INSERT INTO jobs (id, srcpkg, status, log, buildlog, size, queued_timestamp) VALUES (?, ?, 'pending', '', '', ?, ?)",
+                             zip(ids, names, sizes, [time.time()] * len(names)))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+        self.notify()
+        return ids
+
+    # wake workers waiting for jobs (e.g. when a job has been made pending
+    # again)
+    def notify(self):
+        with self.added:
+            self.generation += 1
+            self.added.notify_all()
+
+    # wait until jobs are added, or |timeout| seconds pass
+    #
+    # (|generation| is the value of self.generation before the caller last
+    # looked for a pending job, so jobs added since then aren't missed)
+    def wait(self, generation, timeout):
+        with self.added:
+            return self.added.wait_for(lambda: self.generation != generation, timeout)
+
+    # predict the runtime of each of the |pending| jobs, returning a dict
+    # mapping job id to seconds
+    def predict(self, conn, pending):
+        # the average total duration of the most recent builds of each package
+        # (jobs which didn't build, e.g. because a build result was reused,
+        # aren't a guide)
+        packages = list({package(p[1]) for p in pending})
+        history = {}
+        for i in range(0, len(packages), 500):
+            chunk = packages[i:i + 500]
+            history.update(conn.execute('''SELECT package, AVG(total) FROM
+                                           (SELECT package, SUM(duration) AS total, ROW_NUMBER() OVER (PARTITION BY package ORDER BY jobid DESC) AS n
+                                            FROM steps WHERE package IN (%s) GROUP BY jobid, package HAVING MAX(step = 'build'))
+                                           WHERE n <= ? GROUP BY package''' % ','.join('?' * len(chunk)),
+                                        chunk + [PREDICT_HISTORY]))
+
+        # the rate recent builds have gone at, in seconds per byte of srcpkg
+        rate = conn.execute('''SELECT SUM(total) / SUM(size) FROM
+                               (SELECT SUM(duration) AS total, jobs.size AS size FROM steps JOIN jobs ON steps.jobid = jobs.id
+                                WHERE jobs.size > 0 GROUP BY steps.jobid HAVING MAX(step = 'build') ORDER BY steps.jobid DESC LIMIT 1000)''').fetchone()[0] or DEFAULT_RATE
+
+        predicted = {}
+        for (jobid, srcpkg, force, size, queued) in pending:
+            if package(srcpkg) in history:
+                predicted[jobid] = history[package(srcpkg)]
+            elif size:
+                predicted[jobid] = size * rate
+            else:
+                predicted[jobid] = DEFAULT_PREDICTION
+        return predicted
+
+    # atomically claim the next pending job, so that concurrent workers never
+    # both pick up the same one, returning (id, srcpkg, force), or None if
+    # there isn't one
+    #
+    # the job with the shortest predicted runtime, less an allowance for the
+    # time it's been waiting, is claimed (jobs queued before the queue time
+    # was recorded are treated as having waited forever, so go first)
+    def claim_next(self):
+        conn = self.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            job = None
+            pending = conn.execute("SELECT id, srcpkg, force, size, queued_timestamp FROM jobs WHERE status = 'pending'").fetchall()
+            if pending:
+                predicted = self.predict(conn, pending)
+                now = time.time()
+                job = min(pending, key=lambda p: (predicted[p[0]] - self.aging * (now - (p[4] or 0)), p[0]))[:3]
+                logging.info('jobid %d: predicted runtime %d seconds, %d jobs pending' % (job[0], predicted[job[0]], len(pending)))
+                conn.execute("UPDATE jobs SET status = 'in-progress' WHERE id = ?", (job[0],))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+        return job
+
+    def start(self, jobid, log):
+        self.conn().execute("UPDATE jobs SET status = 'in-progress', log = ?, start_timestamp = ? WHERE id = ?",
+                            (log, time.time(), jobid))
+
+    # record the |steps| of a job, a list of (name, start, end) as kept by a
+    # steptimer.StepTimer
+    def record_steps(self, jobid, srcpkg, steps):
+        self.conn().executemany('INSERT INTO steps (jobid, package, step, duration, start_offset, end_offset) VALUES (?, ?, ?, ?, ?, ?)',
+                                [(jobid, package(srcpkg), name, end - start, start, end) for (name, start, end) in steps])
+
+    def finish(self, jobid, status, buildlog, built, valid, cached):
+        self.conn().execute("UPDATE jobs SET status = ?, buildlog = ?, built = ?, valid = ?, end_timestamp = ?, cached = ? WHERE id = ?",
+                            (status, buildlog, built, valid, time.time(), cached, jobid))
+
+
+#
+# measure adding and claiming jobs with a large job history
+#
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        jobs = JobStore(os.path.join(tmpdir, 'jobs.db'))
+
+        start = time.time()
+        for i in range(0, n, 10000):
+            ids = jobs.add(['x86_64/release/p%d/p%d-1.0-1-src.tar.xz' % (j, j) for j in range(i, min(n, i + 10000))])
+        jobs.conn().execute("UPDATE jobs SET status = 'processed'")
+        print('added %d jobs in %.2f seconds' % (n, time.time() - start))
+
+        start = time.time()
+        ids = jobs.add(['x86_64/release/q/q-1.0-1-src.tar.xz'] * 100)
+        print('added 100 jobs in %.4f seconds' % (time.time() - start))
+
+        # concurrent workers claim each job once
+        claimed = []
+        def worker():
+            while True:
+                job = jobs.claim_next()
+                if not job:
+                    break
+                claimed.append(job[0])
+
+        start = time.time()
+        threads = [threading.Thread(target=worker) for i in range(0, 4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        print('claimed 100 jobs in %.4f seconds' % (time.time() - start))
+
+        assert sorted(claimed) == ids
+
+        # a waiting worker is woken by a job being added
+        generation = jobs.generation
+        threading.Timer(0.1, jobs.add, [['x86_64/release/r/r-1.0-1-src.tar.xz']]).start()
+        start = time.time()
+        assert jobs.wait(generation, 10)
+        print('woken by an added job after %.4f seconds' % (time.time() - start))
+
+        # small jobs are claimed before big ones, unless the big ones have
+        # been waiting long enough
+        jobs.add(['x86_64/release/big/big-1.0-1-src.tar.xz', 'x86_64/release/small/small-1.0-1-src.tar.xz'])
+        while True:
+            job = jobs.claim_next()
+            if not job:
+                break
+            jobs.record_steps(job[0], job[1], [('analyze', 0, 1), ('build', 1, 3600 if 'big' in job[1] else 60)])
+        jobs.conn().execute("UPDATE jobs SET status = 'processed'")
+
+        big = jobs.add(['x86_64/release/big/big-1.0-2-src.tar.xz'])
+        small = jobs.add(['x86_64/release/small/small-1.0-2-src.tar.xz', 'x86_64/release/new/new-1.0-1-src.tar.xz'],
+                         [None, 1024])
+        start = time.time()
+        claimed = [jobs.claim_next()[0] for i in range(0, 3)]
+        print('claimed 3 jobs in %.4f seconds' % (time.time() - start))
+        assert claimed == [small[1], small[0], big[0]]
+
+        big = jobs.add(['x86_64/release/big/big-1.0-3-src.tar.xz'])
+        jobs.conn().execute('UPDATE jobs SET queued_timestamp = ? WHERE id = ?', (time.time() - 7200, big[0]))
+        small = jobs.add(['x86_64/release/small/small-1.0-3-src.tar.xz'])
+        assert jobs.claim_next()[0] == big[0]
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Jon Turney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+#
+# A cache of dependency layers
+#
+# A dependency layer is a qcow2 disk image, linked to the base VM image for an
+# arch, in which a particular set of build dependencies has been installed.  A
+# build with the same set of dependencies can clone it's VM from the layer
+# rather than the base VM image, and skip installing them.
+#
+# Layers are keyed by a hash of the arch, the base VM image and the set of
+# dependencies.  On a miss, a layer is created in the background (by booting a
+# clone of the base VM image, installing the dependencies, and shutting it down
+# cleanly, with at most CREATE_LIMIT of those VMs at once), so that later builds
+# can use it.  Layers are evicted least recently
+# used first, when the total size exceeds the disk budget, or when they are too
+# old (since newer versions of the dependencies may since have been released).
+#
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import libvirt
+
+from cache import LRUCache
+from clone import clone
+from libvirt_qemu_ga_utils import guestExec, guestForget, guestPing, guestSetChunkSizeKey
+import builder
+import virtconn
+
+# how long to wait for the VM to shutdown after installing dependencies
+SHUTDOWN_TIMEOUT = 5*60
+# how many layers to create at once (each boots a VM)
+CREATE_LIMIT = 2
+
+
+class LayerCache(LRUCache):
+    description = 'dependency layer'
+
+    def __init__(self, dbpath, budget, max_age):
+        super().__init__(dbpath, 'layers',
+                         'key text primary key, arch text, depends text, path text, size integer, created integer, last_used integer',
+                         budget, max_age)
+        self.in_use = {}
+        self.retired = set()
+        self.creating = set()
+        self.create_slots = threading.BoundedSemaphore(CREATE_LIMIT)
+
+    # return the path to a layer with |depends| installed for |arch|, or None if
+    # there isn't one (in which case, one is created).  The layer is in use
+    # (and so can't be evicted) until it's released.
+    def get(self, arch, depends):
+        base_file = builder.base_image(arch)
+        key = hashlib.sha256(('%s\n%s\n%d\n%s' % (arch, base_file, os.path.getmtime(base_file), depends)).encode()).hexdigest()
+
+        with self.lock:
+            row = self._lookup(key)
+            if row:
+                logging.info('using dependency layer %s' % (row[0]))
+                self.in_use[row[0]] = self.in_use.get(row[0], 0) + 1
+                return row[0]
+
+            logging.info('no dependency layer for %s' % (depends))
+            if key not in self.creating:
+                self.creating.add(key)
+                threading.Thread(target=self._create, args=(key, arch, depends),
+                                 name='layer-%s' % key[:16], daemon=True).start()
+
+        return None
+
+    def release(self, path):
+        with self.lock:
+            self.in_use[path] -= 1
+            if not self.in_use[path]:
+                del self.in_use[path]
+
+                # remove a layer which was evicted while it was in use
+                if path in self.retired:
+                    self.retired.remove(path)
+                    os.remove(path)
+
+    # (a layer which is in use is removed when it's released)
+    def _remove(self, path):
+        if path in self.in_use:
+            self.retired.add(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _in_use(self, path):
+        return path in self.in_use
+
+    # create a layer, waiting until fewer than CREATE_LIMIT are being created
+    def _create(self, key, arch, depends):
+        try:
+            with self.create_slots:
+                self._create_layer(key, arch, depends)
+        finally:
+            with self.lock:
+                self.creating.discard(key)
+
+    def _create_layer(self, key, arch, depends):
+        vmid = 'layer_%s_%d' % (key[:16], time.time())
+        logging.info('creating dependency layer %s for %s' % (vmid, depends))
+
+        try:
+            conn = virtconn.connection()
+            path = clone(conn, builder.BASE_VMID[arch], vmid)
+            domain = conn.lookupByName(vmid)
+            guestSetChunkSizeKey(domain, builder.BASE_VMID[arch])
+            vm = builder.BuildVM(vmid, domain, path)
+
+            try:
+                success = False
+                if builder.boot_vm(domain, 0) and guestPing(domain):
+                    tr = builder.AgentTransport(vm, arch)
+                    tr.put(['build.sh', 'wrapper.sh'], depends)
+                    success = guestExec(domain, builder.bash_path[arch], ['-l', '/cygdrive/c/vm_in/wrapper.sh', '', r'C:\\vm_out', '', 'depends-only'], timeout=builder.BUILD_TIMEOUT)
+
+                    if success:
+                        # shutdown cleanly, so everything is written to disk
+                        stopped = virtconn.domain_stopped(domain, SHUTDOWN_TIMEOUT)
+                        domain.shutdownFlags(libvirt.VIR_DOMAIN_SHUTDOWN_GUEST_AGENT)
+                        success = stopped.result()
+
+                if domain.isActive():
+                    domain.destroy()
+            finally:
+                guestForget(domain)
+                domain.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_MANAGED_SAVE |
+                                     libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA |
+                                     libvirt.VIR_DOMAIN_UNDEFINE_NVRAM)
+
+            if not success:
+                logging.error('creating dependency layer %s failed' % (vmid))
+                os.remove(path)
+                return
+
+            # the layer must not change now, since it will be linked to
+            os.chmod(path, 0o444)
+
+            with self.lock:
+                self.conn.execute('INSERT OR REPLACE INTO layers VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  (key, arch, depends, path, os.path.getsize(path), time.time(), time.time()))
+                self.conn.commit()
+                self._trim()
+
+            logging.info('created dependency layer %s' % (path))
+        except Exception:
+            logging.exception('creating dependency layer %s failed' % (vmid))
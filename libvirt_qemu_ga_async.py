@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Jon Turney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+#
+# asyncio versions of the functions in libvirt_qemu_ga_utils, with the same
+# names and semantics
+#
+# libvirt_qemu.qemuAgentCommand() blocks, so each agent command is run in a
+# bounded pool of threads.  But only for the duration of that command: between
+# commands (e.g. while waiting between polls of a guest process' status, or
+# while a chunk of a file transfer is being encoded or written) no thread is
+# tied up, so one event loop can drive many domains at once.
+#
+
+import asyncio
+import binascii
+import concurrent.futures
+import libvirt
+import logging
+import os
+import threading
+import time
+
+import libvirt_qemu_ga_utils as ga
+
+# the maximum number of agent commands (or host file operations) in progress at
+# once
+AGENT_THREADS = 16
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(AGENT_THREADS, thread_name_prefix='qemu-ga')
+        return _executor
+
+
+async def _run(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), func, *args)
+
+
+async def _exec_agent_cmd(instance, command):
+    return await _run(ga._exec_agent_cmd, instance, command)
+
+#
+# these consist of a few agent commands, so just run them in the pool
+#
+
+async def guestPing(domain):
+    return await _run(ga.guestPing, domain)
+
+
+async def guestSetTime(domain):
+    return await _run(ga.guestSetTime, domain)
+
+
+async def guestChunkSize(instance):
+    return await _run(ga.guestChunkSize, instance)
+
+
+async def guestFileRead(instance, path):
+    return await _run(ga.guestFileRead, instance, path)
+
+
+async def guestFileWrite(instance, path, content):
+    return await _run(ga.guestFileWrite, instance, path, content)
+
+#
+# copy a file to or from the guest
+#
+
+# wait for |pending| (a read or write of a host file which is running in the
+# pool, which can't be cancelled) to finish, if it hasn't already, ignoring
+# it's outcome, since it's only needed if there wasn't an error
+async def _settle(pending):
+    if pending:
+        try:
+            await pending
+        except Exception:
+            pass
+
+
+async def guestFileCopyFrom(instance, guestPath, hostPath):
+    logging.info("guestFileCopyFrom: guest %s -> host %s" % (guestPath, hostPath))
+    tmp = ga._copy_tmp(hostPath)
+    success = False
+    try:
+        f = await _run(open, tmp, 'wb')
+        try:
+            success = await guestFileReadInto(instance, guestPath, f)
+        finally:
+            await _run(f.close)
+        if success:
+            await _run(os.replace, tmp, hostPath)
+    finally:
+        if not success and os.path.exists(tmp):
+            await _run(os.remove, tmp)
+    return success
+
+
+def _decode_and_write(f, encoded_content):
+    f.write(binascii.a2b_base64(encoded_content))
+
+
+async def guestFileReadInto(instance, guestPath, f):
+    chunk = await guestChunkSize(instance)
+    start = time.monotonic()
+    total = 0
+    pending = None
+    try:
+        file_handle = (await _exec_agent_cmd(instance, ga.FILE_OPEN % (guestPath, 'r')))['return']
+
+        # decode and write each chunk while the next one is being read
+        pending = None
+        while True:
+            result = (await _exec_agent_cmd(instance, ga.FILE_READ % (file_handle, chunk)))["return"]
+
+            if pending:
+                await pending
+                pending = None
+
+            # (eof may be indicated along with the final data)
+            if result['count']:
+                pending = asyncio.ensure_future(_run(_decode_and_write, f, result['buf-b64']))
+                total += result['count']
+
+            if result['eof'] or not result['count']:
+                break
+
+        if pending:
+            await pending
+
+        await _exec_agent_cmd(instance, ga.FILE_CLOSE % file_handle)
+    except libvirt.libvirtError:
+        return False
+    finally:
+        # the caller may close |f| once we return, so finish writing to it
+        await _settle(pending)
+
+    ga._log_transfer_rate("guestFileCopyFrom", total, start)
+    return True
+
+
+async def guestFileCopyTo(instance, hostPath, guestPath):
+    logging.info("guestFileCopyTo: host %s -> guest %s" % (hostPath, guestPath))
+    chunk = await guestChunkSize(instance)
+    start = time.monotonic()
+    total = 0
+
+    # read each chunk into the same buffer, and encode it from there
+    buf = bytearray(chunk)
+    view = memoryview(buf)
+
+    def read_chunk(f):
+        count = f.readinto(buf)
+        return count, binascii.b2a_base64(view[:count], newline=False).decode('ascii')
+
+    f = await _run(open, hostPath, 'rb')
+    pending = None
+    try:
+        file_handle = (await _exec_agent_cmd(instance, ga.FILE_OPEN % (guestPath, 'w+')))["return"]
+
+        # read and encode the next chunk while this one is being written
+        pending = asyncio.ensure_future(_run(read_chunk, f))
+        while True:
+            count, encoded_content = await pending
+            if not count:
+                break
+
+            pending = asyncio.ensure_future(_run(read_chunk, f))
+            write_count = (await _exec_agent_cmd(instance, ga.FILE_WRITE % (file_handle, encoded_content)))["return"]["count"]
+
+            # if write_count != content, there is some kind of error...
+            if write_count != count:
+                logging.error("write error while copying to guest %d %d" % (write_count, count))
+
+            total += count
+
+        await _exec_agent_cmd(instance, ga.FILE_CLOSE % file_handle)
+    except libvirt.libvirtError:
+        return
+    finally:
+        # don't close |f| while a chunk is still being read from it
+        await _settle(pending)
+        await _run(f.close)
+
+    ga._log_transfer_rate("guestFileCopyTo", total, start)
+
+#
+# invoke a command in the guest
+# capture it's exitstatus and output
+#
+
+async def guestExec(instance, command, params, timeout=None):
+    logging.info("guestExec: %s %s" % (command, ' '.join(params)))
+    paramlist = ','.join(['"%s"' % p for p in params])
+    try:
+        start = time.monotonic()
+        pid = (await _exec_agent_cmd(instance, ga.GUEST_EXEC % (command, paramlist)))["return"]["pid"]
+
+        # poll for "exited" to change from "false", to indicate process has
+        # finished...
+        polls = 0
+        interval = 0
+        while True:
+            result = await _exec_agent_cmd(instance, ga.GUEST_EXEC_STATUS % (pid))
+            polls += 1
+
+            result = result['return']
+            if result['exited']:
+                break
+
+            elapsed = time.monotonic() - start
+            if (timeout is not None) and (elapsed > timeout):
+                logging.error('guestExec: pid %d still running after %d seconds, killing it' % (pid, timeout))
+                await _exec_agent_cmd(instance, ga.GUEST_KILL % (pid))
+                return False
+
+            interval = min(max(interval * 2, ga.POLL_MIN), ga.POLL_MAX)
+            await asyncio.sleep(interval)
+
+    except libvirt.libvirtError:
+        return False
+
+    return ga._exec_result(result, start, polls, interval)
+
+
+#
+# check failures are handled cleanly, using the libvirt test driver (which
+# doesn't have a guest agent, so every agent command fails), then ping all the
+# running domains on the hypervisor |uri|, if given, and run a trivial command
+# in each, all at once
+#
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    import warnings
+
+    logging.basicConfig(level=logging.INFO)
+    warnings.simplefilter('error', ResourceWarning)
+
+    async def test():
+        conn = libvirt.open('test:///default')
+        domain = conn.lookupByName('test')
+
+        assert await guestPing(domain) == False
+        assert await guestExec(domain, 'cmd', ['/C', 'ver']) == False
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fn = os.path.join(tmpdir, 'file')
+            with open(fn, 'wb') as f:
+                f.write(bytes(1024*1024))
+
+            # concurrent transfers which all fail
+            await asyncio.gather(*[guestFileCopyTo(domain, fn, r'C:\\file') for i in range(0, 2*AGENT_THREADS)])
+            assert await guestFileCopyFrom(domain, r'C:\\file', fn + '.copy') == False
+
+    async def check(domain):
+        if await guestPing(domain):
+            await guestExec(domain, 'cmd', ['/C', 'ver'])
+
+    async def main(uri):
+        conn = libvirt.open(uri)
+        domains = conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        await asyncio.gather(*[check(d) for d in domains])
+
+    asyncio.run(test(), debug=True)
+    print('ok')
+
+    if len(sys.argv) > 1:
+        asyncio.run(main(sys.argv[1]))
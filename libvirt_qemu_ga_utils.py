@@ -37,11 +37,15 @@
 #
 
 import base64
+import binascii
+import concurrent.futures
 import json
 import libvirt
 import libvirt_qemu
 import logging
+import os
 import re
+import threading
 import time
 
 #
@@ -50,12 +54,16 @@ import time
 
 # XXX: take care: an unescaped '\' in a path is not permitted in json
 def _exec_agent_cmd(instance, command):
-    logging.debug("command %s" % re.sub('"buf-b64":".*"', '"buf-b64":"..."', command))
+    # (avoid formatting large file transfer commands when they won't be logged)
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    if debug:
+        logging.debug("command %s" % re.sub('"buf-b64":".*"', '"buf-b64":"..."', command))
 
     result = libvirt_qemu.qemuAgentCommand(instance, command, libvirt_qemu.VIR_DOMAIN_QEMU_AGENT_COMMAND_BLOCK, 0)
     json_result = json.loads(result)
 
-    logging.debug("result %s " % re.sub('"buf-b64":".*"', '"buf-b64":"..."', json.dumps(json_result, sort_keys=True, indent=4)))
+    if debug:
+        logging.debug("result %s " % re.sub('"buf-b64":".*"', '"buf-b64":"..."', json.dumps(json_result, sort_keys=True, indent=4)))
     return json_result
 
 
@@ -73,6 +81,21 @@ def guestPing(domain):
         return False
 
 
+#
+# set the guest's clock to the host's time (e.g. after the guest has been
+# resumed from a saved state, when it's clock will be behind)
+#
+
+SET_TIME = """{"execute":"guest-set-time", "arguments":{"time":%d}}"""
+
+def guestSetTime(domain):
+    try:
+        result = _exec_agent_cmd(domain, SET_TIME % (time.time_ns()))
+        return 'return' in result
+    except libvirt.libvirtError:
+        return False
+
+
 #
 # copy a file to or from the guest
 #
@@ -83,9 +106,95 @@ FILE_WRITE = """{"execute":"guest-file-write", "arguments":{"handle":%s,"buf-b64
 FILE_CLOSE = """{"execute":"guest-file-close", "arguments":{"handle":%s}}"""
 
 # It's a property of QMP that messages have some upper limit in size, but we
-# aren't sure how much...  ; we also must allow for the overhead of the json
-# structure the data is encapsulated in
+# aren't sure how much...  ; we also must allow for the overhead of the base64
+# encoding and the json structure the data is encapsulated in.
+#
+# So, starting from CHUNK, which is known to be safe, we probe upwards through
+# CHUNK_SIZES for the largest chunk size which can be written and read back.
+# (We probe upwards, in case an oversized message upsets the agent connection)
+#
+# libvirt limits strings in it's RPC messages to 4MiB, so a chunk which is
+# larger than 3MiB once base64 encoded can never succeed, and isn't tried.
+#
+# Probing moves a few MB through the agent, so the result is remembered for
+# all guests with the same key (e.g. all clones of the same base VM image, see
+# guestSetChunkSizeKey()), or otherwise for each guest, until it's forgotten
+# with guestForget().
 CHUNK = 4096
+CHUNK_SIZES = [64*1024, 256*1024, 1024*1024, 2*1024*1024]
+PROBE_PATH = r'C:\\carpetbag_probe'
+
+_chunk_sizes = {}
+_chunk_size_keys = {}
+_chunk_sizes_lock = threading.Lock()
+
+def _probe_chunk_size(instance, size):
+    content = base64.standard_b64encode(bytes(size)).decode('ascii')
+    file_handle = None
+    try:
+        file_handle = _exec_agent_cmd(instance, FILE_OPEN % (PROBE_PATH, 'w+'))["return"]
+        write_count = _exec_agent_cmd(instance, FILE_WRITE % (file_handle, content))["return"]["count"]
+        _exec_agent_cmd(instance, FILE_CLOSE % file_handle)
+        file_handle = None
+
+        file_handle = _exec_agent_cmd(instance, FILE_OPEN % (PROBE_PATH, 'r'))["return"]
+        read_count = _exec_agent_cmd(instance, FILE_READ % (file_handle, size))["return"]["count"]
+        _exec_agent_cmd(instance, FILE_CLOSE % file_handle)
+        file_handle = None
+    except (libvirt.libvirtError, KeyError):
+        return False
+    finally:
+        if file_handle is not None:
+            try:
+                _exec_agent_cmd(instance, FILE_CLOSE % file_handle)
+            except libvirt.libvirtError:
+                pass
+
+    return (write_count == size) and (read_count == size)
+
+
+# chunk sizes probed for |instance| are remembered under |key|
+def guestSetChunkSizeKey(instance, key):
+    with _chunk_sizes_lock:
+        _chunk_size_keys[instance.UUIDString()] = key
+
+
+# forget about |instance| (e.g. when it is destroyed)
+def guestForget(instance):
+    uuid = instance.UUIDString()
+    with _chunk_sizes_lock:
+        _chunk_size_keys.pop(uuid, None)
+        _chunk_sizes.pop(uuid, None)
+
+
+def guestChunkSize(instance):
+    uuid = instance.UUIDString()
+    with _chunk_sizes_lock:
+        key = _chunk_size_keys.get(uuid, uuid)
+        if key in _chunk_sizes:
+            return _chunk_sizes[key]
+
+    size = CHUNK
+    try:
+        for candidate in CHUNK_SIZES:
+            if not _probe_chunk_size(instance, candidate):
+                break
+            size = candidate
+    finally:
+        guestExec(instance, 'cmd', ['/C', 'del', PROBE_PATH])
+
+    logging.info("guest agent file transfer chunk size is %d" % size)
+
+    with _chunk_sizes_lock:
+        _chunk_sizes[key] = size
+    return size
+
+
+def _log_transfer_rate(name, count, start):
+    elapsed = time.monotonic() - start
+    rate = (count / (1024*1024)) / elapsed if elapsed > 0 else 0
+    logging.info("%s: %d bytes in %.2f seconds, %.2f MB/s" % (name, count, elapsed, rate))
+
 
 def guestFileRead(instance, path):
     file_handle = -1
@@ -99,22 +208,62 @@ def guestFileRead(instance, path):
     return base64.standard_b64decode(file_content)
 
 
+# (the copy is written to a temporary file, which only replaces |hostPath| if
+# it succeeds, so an existing file isn't lost if it fails)
+def _copy_tmp(hostPath):
+    return '%s.%d.%d.tmp' % (hostPath, os.getpid(), threading.get_ident())
+
+
 def guestFileCopyFrom(instance, guestPath, hostPath):
     logging.info("guestFileCopyFrom: guest %s -> host %s" % (guestPath, hostPath))
+    tmp = _copy_tmp(hostPath)
+    success = False
+    try:
+        with open(tmp, 'wb') as f:
+            success = guestFileReadInto(instance, guestPath, f)
+        if success:
+            os.replace(tmp, hostPath)
+    finally:
+        if not success and os.path.exists(tmp):
+            os.remove(tmp)
+    return success
+
+
+# copy a file from the guest into the host file object |f|, which may be a pipe
+# (so the content can be processed as it arrives).  Returns True on success.
+def guestFileReadInto(instance, guestPath, f):
+    chunk = guestChunkSize(instance)
+    start = time.monotonic()
+    total = 0
     try:
         file_handle = _exec_agent_cmd(instance, FILE_OPEN % (guestPath, 'r'))['return']
-        with open(hostPath, 'wb') as f:
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            # decode and write each chunk while the next one is being read
+            pending = None
             while True:
-                result = _exec_agent_cmd(instance, FILE_READ % (file_handle, CHUNK))["return"]
-                if result['eof']:
+                result = _exec_agent_cmd(instance, FILE_READ % (file_handle, chunk))["return"]
+
+                if pending:
+                    pending.result()
+                    pending = None
+
+                # (eof may be indicated along with the final data)
+                if result['count']:
+                    pending = executor.submit(lambda e: f.write(binascii.a2b_base64(e)), result['buf-b64'])
+                    total += result['count']
+
+                if result['eof'] or not result['count']:
                     break
 
-                encoded_content = result['buf-b64']
-                content = base64.standard_b64decode(encoded_content)
-                f.write(content)
+            if pending:
+                pending.result()
+
         _exec_agent_cmd(instance, FILE_CLOSE % file_handle)
     except libvirt.libvirtError:
-        return
+        return False
+
+    _log_transfer_rate("guestFileCopyFrom", total, start)
+    return True
 
 
 def guestFileWrite(instance, path, content):
@@ -131,25 +280,43 @@ def guestFileWrite(instance, path, content):
 
 def guestFileCopyTo(instance, hostPath, guestPath):
     logging.info("guestFileCopyTo: host %s -> guest %s" % (hostPath, guestPath))
+    chunk = guestChunkSize(instance)
+    start = time.monotonic()
+    total = 0
+
+    # read each chunk into the same buffer, and encode it from there
+    buf = bytearray(chunk)
+    view = memoryview(buf)
+
+    def read_chunk(f):
+        count = f.readinto(buf)
+        return count, binascii.b2a_base64(view[:count], newline=False).decode('ascii')
+
     try:
         file_handle = _exec_agent_cmd(instance, FILE_OPEN % (guestPath, 'w+'))["return"]
-        with open(hostPath, 'rb') as f:
+        with open(hostPath, 'rb') as f, concurrent.futures.ThreadPoolExecutor(1) as executor:
+            # read and encode the next chunk while this one is being written
+            pending = executor.submit(read_chunk, f)
             while True:
-                content = f.read(CHUNK)
-                if not content:
+                count, encoded_content = pending.result()
+                if not count:
                     break
 
-                encoded_content = base64.standard_b64encode(content).decode('ascii')
+                pending = executor.submit(read_chunk, f)
                 write_count = _exec_agent_cmd(instance, FILE_WRITE % (file_handle, encoded_content))["return"]["count"]
 
                 # if write_count != content, there is some kind of error...
-                if write_count != len(content):
-                    logging.error("write error while copying to guest %d %d" % (write_count, len(content)))
+                if write_count != count:
+                    logging.error("write error while copying to guest %d %d" % (write_count, count))
+
+                total += count
 
         _exec_agent_cmd(instance, FILE_CLOSE % file_handle)
     except libvirt.libvirtError:
         return
 
+    _log_transfer_rate("guestFileCopyTo", total, start)
+
 
 #
 # invoke a command in the guest
@@ -158,51 +325,79 @@ def guestFileCopyTo(instance, hostPath, guestPath):
 
 GUEST_EXEC       ="""{"execute":"guest-exec", "arguments":{"path":"%s", "arg":[%s], "capture-output": true}}"""
 GUEST_EXEC_STATUS="""{"execute":"guest-exec-status", "arguments":{"pid":%s}}"""
+GUEST_KILL       ="""{"execute":"guest-exec", "arguments":{"path":"taskkill", "arg":["/F","/T","/PID","%s"]}}"""
 
-def guestExec(instance, command, params):
+# there's no event that tells us the guest agent has some status change to
+# communicate, so we have to poll for the process exiting.  Poll quickly at
+# first, so short commands don't wait needlessly, backing off to POLL_MAX
+# seconds for long-running ones.
+POLL_MIN = 0.01
+POLL_MAX = 2.0
+
+def guestExec(instance, command, params, timeout=None):
     logging.info("guestExec: %s %s" % (command, ' '.join(params)))
     paramlist = ','.join(['"%s"' % p for p in params])
     try:
+        start = time.monotonic()
         pid = _exec_agent_cmd(instance, GUEST_EXEC % (command, paramlist))["return"]["pid"]
 
         # poll for "exited" to change from "false", to indicate process has
         # finished...
-        #
-        # XXX: timeout
-        # XXX: there's no event that tells us the guest agent has some
-        # status change to communicate, so we have to poll here....
-        i = 0
+        polls = 0
+        interval = 0
+        dots = 0
         while True:
             result = _exec_agent_cmd(instance, GUEST_EXEC_STATUS % (pid))
+            polls += 1
 
             result = result['return']
             if result['exited']:
                 break
 
-            time.sleep(1)
-            i += 1
-            if ((i % 60) == 0):
+            elapsed = time.monotonic() - start
+            if (timeout is not None) and (elapsed > timeout):
+                logging.error('guestExec: pid %d still running after %d seconds, killing it' % (pid, timeout))
+                _exec_agent_cmd(instance, GUEST_KILL % (pid))
+                if dots:
+                    print('')
+                return False
+
+            interval = min(max(interval * 2, POLL_MIN), POLL_MAX)
+            time.sleep(interval)
+
+            if int(elapsed / 60) > dots:
+                dots += 1
                 print('.', end='', flush=True)
 
-        if (i >= 60):
+        if dots:
             print('')
 
-        exitcode = result['exitcode']
-        logging.info('exitcode %d' % exitcode)
+    except libvirt.libvirtError:
+        return False
 
-        if 'out-data' in result:
-            stdout = base64.standard_b64decode(result['out-data'])
-            if 'out-truncated' in result:
-                stdout += '(truncated)'
-            logging.info('stdout %s' % stdout)
+    return _exec_result(result, start, polls, interval)
 
-        if 'err-data' in result:
-            stderr = base64.standard_b64decode(result['err-data'])
-            if 'err-truncated' in result:
-                stderr += '(truncated)'
-            logging.info('stderr %s' % stderr)
 
-    except libvirt.libvirtError:
-        return -1
+# log the result of a guest command which has exited, and return if it was
+# successful
+def _exec_result(result, start, polls, interval):
+    # the process exited sometime during the last interval we slept for, so
+    # that bounds the latency polling added
+    logging.info('guestExec: exited after %.2f seconds, %d polls, polling latency at most %.2f seconds' % (time.monotonic() - start, polls, interval))
+
+    exitcode = result['exitcode']
+    logging.info('exitcode %d' % exitcode)
+
+    if 'out-data' in result:
+        stdout = base64.standard_b64decode(result['out-data'])
+        if 'out-truncated' in result:
+            stdout += b'(truncated)'
+        logging.info('stdout %s' % stdout)
+
+    if 'err-data' in result:
+        stderr = base64.standard_b64decode(result['err-data'])
+        if 'err-truncated' in result:
+            stderr += b'(truncated)'
+        logging.info('stderr %s' % stderr)
 
     return (exitcode == 0)
@@ -21,24 +21,43 @@
 # THE SOFTWARE.
 #
 
-import datetime
 import errno
 import logging
 import os
 import shutil
-import sqlite3
+import signal
 import tempfile
 import threading
 import time
 
 from dirq.QueueSimple import QueueSimple
-from analyze import analyze, PackageKind
-from builder import build
-from verify import verify
+from analyze import AnalysisCache, PackageKind
+from builder import build, POOL_SIZE, LAYER_BUDGET, LAYER_MAX_AGE
+from dirwatch import DirWatcher
+from jobstore import JobStore
+from layers import LayerCache
+from results import ResultCache, upload_digest
+from verify import digest_tree, read_digests, start_workers, verify
+from steptimer import StepTimer
+from vmpool import VMPool
 
 #
 debug = True
 test = False
+# number of concurrent build workers
+workers = 4
+# keep a pool of booted VMs ready for builds
+use_pool = True
+# keep disk image layers with dependencies already installed
+use_layers = True
+# reuse the results of building identical inputs
+use_results = True
+# build even if there's a result for identical inputs (a job can also be made to
+# rebuild by setting it's force column)
+force_rebuild = False
+# after a pull is requested, wait this many seconds for any further requests, so
+# a burst of them only causes one pull
+PULL_COALESCE = 10
 
 #
 #
@@ -69,6 +88,10 @@ fh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)-8s - %(message)s')
 fh.setLevel(logging.DEBUG)
 logging.getLogger().addHandler(fh)
 
+# start the verification worker processes (this must be done before any threads
+# are started)
+start_workers()
+
 # initialize work queue
 carpetbag_root = '/var/lib/carpetbag'
 q_root = os.path.join(carpetbag_root, 'dirq')
@@ -76,27 +99,13 @@ UPLOADS = os.path.join(carpetbag_root, 'uploads')
 QUEUE = 'package_queue'
 
 dirq = QueueSimple(os.path.join(q_root, QUEUE))
-
-# initialize persistent jobid
-jobid_file = os.path.join(carpetbag_root, 'jobid')
-jobid = 0
-try:
-    with open(jobid_file) as f:
-        jobid = int(f.read())
-except IOError:
-    pass
-with open(jobid_file, 'w') as f:
-    f.write(str(jobid))
+watcher = DirWatcher(os.path.join(q_root, QUEUE))
 
 # initialize database
-def adapt_datetime(ts):
-    return time.mktime(ts.timetuple())
-
-sqlite3.register_adapter(datetime.datetime, adapt_datetime)
+# (job ids used to be allocated from the jobid file, which is only read now)
+jobs = JobStore(os.path.join(carpetbag_root, 'carpetbag.db'), os.path.join(carpetbag_root, 'jobid'))
 
-conn = sqlite3.connect(os.path.join(carpetbag_root, 'carpetbag.db'))
-conn.execute('''CREATE TABLE IF NOT EXISTS jobs
-                (id integer primary key, srcpkg text, status text, log text, buildlog text, built integer, valid integer, start_timestamp integer, end_timestamp integer)''')
+analysis_cache = AnalysisCache(os.path.join(carpetbag_root, 'carpetbag.db'))
 
 #
 #
@@ -104,7 +113,6 @@ conn.execute('''CREATE TABLE IF NOT EXISTS jobs
 
 # pull queues
 def pull_queue():
-    conn = sqlite3.connect(os.path.join(carpetbag_root, 'carpetbag.db'))
     logging.info('pulling')
 
     if test:
@@ -121,27 +129,36 @@ def pull_queue():
     os.system('%s %suploads/ %s' % (rsync_cmd, remote, UPLOADS))
     os.system('%s %sdirq/ %s' % (rsync_cmd, remote, q_root))
 
+    # make sure anything pulled is ingested now, even if it wasn't noticed
+    watcher.notify()
+
+
+# move items from the local queue into the jobs table
+def ingest_queue():
     # look for work in queue
-    logging.info('scanning queue for work')
+    logging.debug('scanning queue for work')
+    items = []
     for work in dirq:
         if not dirq.lock(work):
             continue
 
-        # increment jobid
-        with open(jobid_file) as f:
-            jobid = int(f.read())
-        jobid = jobid + 1
-        with open(jobid_file, 'w') as f:
-            f.write(str(jobid))
-
         # the queue item is the relative path of the srcpkg file
-        name = dirq.get(work).decode()
-        logging.info('jobid %d: queueing %s' % (jobid, name))
+        items.append((work, dirq.get(work).decode()))
+
+    # the srcpkg size is used to predict how long a job will take, if the
+    # package hasn't been built before
+    sizes = []
+    for (work, name) in items:
+        try:
+            sizes.append(os.path.getsize(os.path.join(UPLOADS, name)))
+        except OSError:
+            sizes.append(None)
 
-        # store in database
-        conn.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                     (jobid, name, 'pending', '', '', None, None, None, None))
-        conn.commit()
+    # store in database, all in one go
+    ids = jobs.add([name for (work, name) in items], sizes)
+
+    for (jobid, (work, name)) in zip(ids, items):
+        logging.info('jobid %d: queueing %s' % (jobid, name))
 
         # remove item from queue
         dirq.remove(work)
@@ -150,102 +167,183 @@ def pull_queue():
     dirq.purge()
 
 
+pull_requested = threading.Event()
+
+
+# ask for the queue to be pulled now, rather than when it's next due
+def request_pull():
+    pull_requested.set()
+
+
 def pull_queue_thread():
     while True:
         # pull queue
         pull_queue()
 
         # schedule to run again
-        # (there's no point pulling any more often than calm runs)
+        # (there's no point pulling any more often than calm runs, unless asked
+        # to)
         if test:
             delay = 60
         else:
             delay = 60*60
-            logging.info('will pull again in %d seconds', delay)
-        time.sleep(delay)
-
-
-# look for pending items in database
-def pending_work():
-    conn = sqlite3.connect(os.path.join(carpetbag_root, 'carpetbag.db'))
-    pending = list(conn.execute("SELECT id, srcpkg FROM jobs WHERE status = 'pending'"))[:1]
-    for jobid, name in pending:
-        built = False
-        valid = None
-        build_logfile = None
+            logging.info('will pull again in %d seconds, or when requested', delay)
 
-        # start logging (of this thread only) to job logfile
-        this_thread = threading.get_ident()
-        def threadFilter(record):
-            return (record.thread == this_thread)
+        if pull_requested.wait(delay):
+            # let any more requests arrive before pulling
+            time.sleep(PULL_COALESCE)
+            logging.info('pull requested')
+        pull_requested.clear()
 
-        job_logfile = os.path.join('/var/log/carpetbag', '%d.log' % jobid)
-        fh = logging.FileHandler(job_logfile, mode='w')
-        fh.addFilter(threadFilter)
-        logging.getLogger().addHandler(fh)
 
-        logging.info('jobid %d: processing %s' % (jobid, name))
-
-        #
-        reldir = os.path.dirname(name)
-        outdir = tempfile.mkdtemp(prefix='carpetbag_')
-        indir = os.path.join(UPLOADS, reldir)
+# ingest items as they are added to the local queue (either by a pull, or
+# directly), looking again every so often in case something was missed
+def ingest_queue_thread():
+    while True:
+        ingest_queue()
+        watcher.wait(60)
+
+
+# process a job
+def pending_work(jobid, name, force=False):
+    built = False
+    valid = None
+    cached = False
+    build_logfile = None
+
+    # start logging (of this thread only) to job logfile
+    this_thread = threading.get_ident()
+    def threadFilter(record):
+        return (record.thread == this_thread)
+
+    job_logfile = os.path.join('/var/log/carpetbag', '%d.log' % jobid)
+    fh = logging.FileHandler(job_logfile, mode='w')
+    fh.addFilter(threadFilter)
+    logging.getLogger().addHandler(fh)
+
+    logging.info('jobid %d: processing %s' % (jobid, name))
+
+    #
+    reldir = os.path.dirname(name)
+    outdir = tempfile.mkdtemp(prefix='carpetbag_')
+    indir = os.path.join(UPLOADS, reldir)
+
+    # update in database
+    jobs.start(jobid, job_logfile)
+
+    # time the steps of this job
+    timer = StepTimer()
+
+    status = 'exception'
+    try:
+        arch = name.split(os.sep)[0]
+
+        srcpkg = os.path.join(UPLOADS, name)
+
+        # examine the source package
+        package = analysis_cache.analyze(srcpkg, indir, arch)
+        timer.mark('analyze')
+
+        if package.kind:
+            # build the packages
+            build_logfile = os.path.join('/var/log/carpetbag', 'build_%d.log' % jobid)
+            releasedir = os.path.join(outdir, arch, 'release')
+            pkgdir = os.path.relpath(reldir, os.path.join(arch, 'release'))
+
+            # products identical to the upload needn't be fetched
+            upload_digests = digest_tree(indir)
+            known = {os.path.join(pkgdir, fn): d for (fn, d) in upload_digests.items()}
+
+            # reuse the result of building identical inputs, if we have one
+            key = None
+            result = None
+            if results:
+                key = results.key(srcpkg, package, arch)
+                if force or force_rebuild:
+                    logging.info('jobid %d: rebuild forced' % (jobid))
+                elif key:
+                    result = results.get(key)
+            timer.mark('prepare')
+
+            if result and results.restore(result, releasedir, build_logfile):
+                logging.info('jobid %d: using build result %s' % (jobid, result.key))
+                timer.mark('restore')
+                built = True
+                cached = True
+            else:
+                built = build(srcpkg, releasedir, package, jobid, build_logfile, arch, pool, layers, known, timer)
+
+            if built:
+                # verify built package
+                digests = None
+                if os.path.exists(os.path.join(releasedir, 'digests')):
+                    digests = read_digests(os.path.join(releasedir, 'digests'), pkgdir)
+
+                udigest = upload_digest(upload_digests)
+                if cached and (result.upload_digest == udigest):
+                    valid = bool(result.valid)
+                    logging.info('upload is the same as when build result was verified, verify %s' % (color_result(valid)))
+                else:
+                    valid = verify(indir, os.path.join(outdir, reldir), digests, upload_digests)
+                    timer.mark('verify')
+
+                    if cached:
+                        results.update_valid(key, udigest, valid)
+                    elif results and key:
+                        # products which weren't fetched, as they were identical
+                        # to the upload
+                        skipped = {os.path.join(pkgdir, fn): os.path.join(indir, fn) for fn in upload_digests
+                                   if digests and (digests.get(fn) == upload_digests[fn])}
+                        results.put(key, releasedir, build_logfile, skipped, udigest, valid)
+                    timer.mark('keep result')
+
+        # one line summary of this job
+        logging.info('jobid %d: processed %s, build %s, verify %s' % (jobid, name, color_result(built), color_result(valid)))
+
+        # clean up
+        if not debug:
+            logging.info('removing %s' % outdir)
+            shutil.rmtree(outdir)
+            logging.info('removing %s' % indir)
+            shutil.rmtree(indir)
+            timer.mark('clean up')
+
+        status = 'processed'
+    except:
+        logging.exception('')
+        raise
+    finally:
+        # stop logging to job logfile
+        logging.getLogger().removeHandler(fh)
 
         # update in database
-        conn.execute("UPDATE jobs SET status = ?, log = ?, start_timestamp = ? WHERE id = ?",
-                     ('in-progress', job_logfile, datetime.datetime.now(), jobid))
-        conn.commit()
-
-        status = 'exception'
-        try:
-            arch = name.split(os.sep)[0]
-
-            srcpkg = os.path.join(UPLOADS, name)
-
-            # examine the source package
-            package = analyze(srcpkg, indir)
-
-            if package.kind:
-                # build the packages
-                build_logfile = os.path.join('/var/log/carpetbag', 'build_%d.log' % jobid)
-                built = build(srcpkg, os.path.join(outdir, arch, 'release'), package, jobid, build_logfile, arch)
-                if built:
-                    # verify built package
-                    valid = verify(indir, os.path.join(outdir, reldir))
-
-            # one line summary of this job
-            logging.info('jobid %d: processed %s, build %s, verify %s' % (jobid, name, color_result(built), color_result(valid)))
+        jobs.finish(jobid, status, build_logfile, built, valid, cached)
 
-            # clean up
-            if not debug:
-                logging.info('removing %s' % outdir)
-                shutil.rmtree(outdir)
-                logging.info('removing %s' % indir)
-                shutil.rmtree(indir)
-
-            status = 'processed'
-        except:
-            logging.exception('')
-            raise
-        finally:
-            # stop logging to job logfile
-            logging.getLogger().removeHandler(fh)
-
-            # update in database
-            conn.execute("UPDATE jobs SET status = ?, buildlog = ?, built = ?, valid = ?, end_timestamp = ? WHERE id = ?",
-                      (status, build_logfile, built, valid, datetime.datetime.now(), jobid))
-            conn.commit()
+        # record how long each step took (which is also used to predict how
+        # long the next build of this package will take)
+        jobs.record_steps(jobid, name, timer.steps)
 
 
+# each worker repeatedly claims a pending job and processes it, each build in
+# it's own buildvm_<jobid> clone
 def pending_work_thread():
     while True:
-        # do any pending work
-        pending_work()
+        generation = jobs.generation
+        job = jobs.claim_next()
+        if job:
+            try:
+                pending_work(*job)
+            except Exception:
+                # already logged and recorded in database, so keep this worker
+                # available for other jobs
+                pass
+            continue
 
-        # schedule to run again after waiting a while
+        # nothing to do, so wait until jobs are added, or a while (in case a
+        # job was made pending some other way), before looking again
         delay = 60
-        logging.info('will process work again in %d seconds', delay)
-        time.sleep(delay)
+        logging.debug('will look for work again when jobs are added, or in %d seconds', delay)
+        jobs.wait(generation, delay)
 
 
 #
@@ -259,5 +357,26 @@ logging.info('uploaded files will be in %s' % (UPLOADS))
 # purge any stale elements, unlock any locked elements
 dirq.purge(1, 1)
 
-threading.Thread(target=pull_queue_thread).start()
-pending_work_thread()
+# start filling the pool of VMs
+pool = None
+if use_pool:
+    pool = VMPool(POOL_SIZE)
+    pool.start()
+
+layers = None
+if use_layers:
+    layers = LayerCache(os.path.join(carpetbag_root, 'carpetbag.db'), LAYER_BUDGET, LAYER_MAX_AGE)
+
+results = None
+if use_results:
+    results = ResultCache(os.path.join(carpetbag_root, 'carpetbag.db'), os.path.join(carpetbag_root, 'results'))
+
+# SIGUSR1 requests a pull of the queue
+signal.signal(signal.SIGUSR1, lambda signum, frame: request_pull())
+
+threading.Thread(target=ingest_queue_thread, name='ingest').start()
+threading.Thread(target=pull_queue_thread, name='pull').start()
+
+logging.info('starting %d build workers' % workers)
+for i in range(0, workers):
+    threading.Thread(target=pending_work_thread, name='worker-%d' % i).start()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Jon Turney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+#
+# Compiled indexes of the dependency mapping files
+#
+# The mapping files (devel_package_map, pkgconfig-map) are python dict literals,
+# mapping a name to a list or set of package names, which are large enough that
+# evaluating them is slow, and holding them in memory is wasteful, when only a
+# handful of lookups are made for each job.
+#
+# So, each is compiled into an sqlite database <file>.idx beside it, with the
+# keys as the primary key, and lookups are made in that.  The index is only
+# rebuilt when the mapping file changes, and isn't opened until the first
+# lookup.
+#
+
+import ast
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+# mapping files are found relative to this file, not the current directory
+basedir = os.path.dirname(os.path.abspath(__file__))
+
+
+class MapIndex:
+    def __init__(self, name):
+        self.source = os.path.join(basedir, name)
+        self.index = self.source + '.idx'
+        self.lock = threading.Lock()
+        self.db = None
+        self.stat = None
+
+    def get(self, key, default=None):
+        with self.lock:
+            self._open()
+            row = self.db.execute('SELECT value FROM map WHERE key = ?', (key,)).fetchone()
+
+        if row is None:
+            return default
+        return frozenset(json.loads(row[0]))
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    # a digest of the mapping file content the index was built from
+    def version(self):
+        with self.lock:
+            self._open()
+            return self.db.execute("SELECT value FROM meta WHERE name = 'digest'").fetchone()[0]
+
+    # open the index (with the lock held), rebuilding it first if the mapping
+    # file has changed since it was built
+    def _open(self):
+        st = os.stat(self.source)
+        stat = '%d %d' % (st.st_mtime_ns, st.st_size)
+
+        if self.db and (self.stat == stat):
+            return
+
+        if self.db:
+            self.db.close()
+            self.db = None
+
+        if os.path.exists(self.index):
+            db = sqlite3.connect(self.index, check_same_thread=False)
+            try:
+                row = db.execute("SELECT value FROM meta WHERE name = 'stat'").fetchone()
+            except sqlite3.Error:
+                row = None
+
+            if row and (row[0] == stat):
+                self.db = db
+                self.stat = stat
+                return
+
+            db.close()
+
+        self._build(stat)
+        self.db = sqlite3.connect(self.index, check_same_thread=False)
+        self.stat = stat
+
+    def _build(self, stat):
+        logging.info('building index %s' % (self.index))
+
+        with open(self.source, 'rb') as f:
+            content = f.read()
+        mapping = ast.literal_eval(content.decode())
+
+        # build it under a temporary name, and then rename it into place, so
+        # it's never seen partially built
+        tmp = '%s.%d.tmp' % (self.index, os.getpid())
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+        db = sqlite3.connect(tmp)
+        db.execute('CREATE TABLE meta (name text primary key, value text)')
+        db.execute('CREATE TABLE map (key text primary key, value text) WITHOUT ROWID')
+        db.executemany('INSERT INTO meta VALUES (?, ?)',
+                       [('stat', stat), ('digest', hashlib.sha256(content).hexdigest())])
+        db.executemany('INSERT INTO map VALUES (?, ?)',
+                       [(k, json.dumps(sorted(v))) for k, v in mapping.items()])
+        db.commit()
+        db.close()
+
+        os.replace(tmp, self.index)
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import tracemalloc
+
+    # compare the time and memory taken to evaluate a mapping file, with
+    # looking a key up in the index
+    name = sys.argv[1] if len(sys.argv) > 1 else 'devel_package_map'
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    mapping = eval(open(os.path.join(basedir, name)).read())
+    key = sorted(mapping)[len(mapping) // 2]
+    value = frozenset(mapping[key])
+    print('eval:   %.4f seconds, %d bytes' % (time.perf_counter() - start, tracemalloc.get_traced_memory()[0]))
+    del mapping
+
+    tracemalloc.stop()
+    tracemalloc.start()
+    index = MapIndex(name)
+    index.get(key)
+    start = time.perf_counter()
+    assert index.get(key) == value
+    assert 'no such key' not in index
+    print('lookup: %.6f seconds, %d bytes' % (time.perf_counter() - start, tracemalloc.get_traced_memory()[0]))
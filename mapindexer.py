@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Jon Turney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+#
+# Regenerate the dependency mapping files (pkgconfig-map and devel_package_map)
+# from a local mirror
+#
+# usage: mapindexer.py [arch ...]
+#
+# Walks <mirror>/<arch>/release, where each directory is a source package, and
+# each directory under it containing packages is an install package built from
+# that source package.
+#
+# - devel_package_map maps each install package to the -devel packages built
+#   from the same source package
+#
+# - pkgconfig-map maps each .pc file to the install packages containing it,
+#   which means listing the contents of the latest binary tarball of every
+#   package.  That's slow, so the mtime and size of each tarball, and the .pc
+#   files found in it, are remembered in a state file, and on later runs only
+#   tarballs which have changed are reopened.
+#
+# The mapping files are written atomically, and their compiled indexes (see
+# mapindex.py) are rebuilt when they are next used.
+#
+
+import concurrent.futures
+import json
+import logging
+import os
+import re
+import sys
+import tarfile
+import time
+
+import mapindex
+
+MIRROR = '/var/ftp/pub/cygwin'
+STATE = os.path.join(mapindex.basedir, 'mapindexer.state')
+
+# the number of tarballs to list at once (decompression mostly releases the
+# GIL, so threads are enough)
+WORKERS = os.cpu_count() or 4
+
+_tarball_re = re.compile(r'^(.+)-(\d[0-9a-zA-Z.]*)\.tar\.(bz2|gz|lzma|xz)$')
+
+
+#
+# the .pc files in a binary tarball
+#
+
+def pc_files(path):
+    pcs = set()
+
+    # an empty file is (sometimes) used for an empty package
+    if os.path.getsize(path) == 0:
+        return []
+
+    with tarfile.open(path, mode='r|*') as tf:
+        for m in tf:
+            if m.isfile() and m.name.endswith('.pc') and '/pkgconfig/' in m.name:
+                pcs.add(os.path.basename(m.name))
+    return sorted(pcs)
+
+
+#
+# find install packages in a source package directory, and the latest (by
+# mtime) binary tarball for each
+#
+
+def install_packages(srcdir):
+    packages = {}
+
+    for (dirpath, subdirs, files) in os.walk(srcdir):
+        p = os.path.basename(dirpath)
+        latest = None
+        for f in files:
+            match = _tarball_re.match(f)
+            if not match or match.group(1).endswith('-src') or not f.startswith(p + '-'):
+                continue
+            st = os.stat(os.path.join(dirpath, f))
+            if (latest is None) or (st.st_mtime > latest[1].st_mtime):
+                latest = (os.path.join(dirpath, f), st)
+
+        if latest or ('setup.hint' in files):
+            packages[p] = latest
+
+    return packages
+
+
+def index(arches, mirror=MIRROR, state_file=STATE):
+    start = time.time()
+
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        state = {}
+
+    devel_map = {}
+    tarballs = {}
+    for arch in arches:
+        releasedir = os.path.join(mirror, arch, 'release')
+        for srcpkg in sorted(os.listdir(releasedir)):
+            srcdir = os.path.join(releasedir, srcpkg)
+            if not os.path.isdir(srcdir):
+                continue
+
+            packages = install_packages(srcdir)
+            devel = sorted([p for p in packages if p.endswith('-devel')])
+            if devel:
+                for p in packages:
+                    if not p.endswith('-devel'):
+                        devel_map.setdefault(p, set()).update(devel)
+
+            for (p, latest) in packages.items():
+                if latest:
+                    tarballs[latest[0]] = (p, '%d %d' % (latest[1].st_mtime_ns, latest[1].st_size))
+
+    # list the tarballs which are new or have changed
+    changed = [t for t in tarballs if (t not in state) or (state[t]['stat'] != tarballs[t][1])]
+    logging.info('%d tarballs, %d to list' % (len(tarballs), len(changed)))
+
+    # the install package each tarball in the state belongs to
+    owners = {t: tarballs[t][0] for t in tarballs}
+
+    with concurrent.futures.ThreadPoolExecutor(WORKERS) as executor:
+        futures = {t: executor.submit(pc_files, t) for t in changed}
+        for t in changed:
+            try:
+                state[t] = {'stat': tarballs[t][1], 'pc': futures[t].result()}
+            except (tarfile.TarError, OSError, EOFError) as e:
+                # (e.g. a bad or truncated upload), keep the previous entries
+                # for this install package, so it's mappings aren't lost
+                # (the tarball is tried again next time, as it's stat won't
+                # match)
+                logging.error('failed to list %s, keeping previous mappings: %s' % (t, e))
+                for u in state:
+                    if (u not in tarballs) and (os.path.dirname(u) == os.path.dirname(t)):
+                        owners[u] = tarballs[t][0]
+
+    # forget tarballs which have gone away
+    state = {t: v for t, v in state.items() if t in owners}
+
+    pkgconfig_map = {}
+    for (t, v) in state.items():
+        for pc in v['pc']:
+            pkgconfig_map.setdefault(pc, set()).add(owners[t])
+
+    write_map('devel_package_map', devel_map, '[%s]')
+    write_map('pkgconfig-map', pkgconfig_map, '{%s}')
+    write_json(state_file, state)
+
+    logging.info('indexed %d packages in %.1f seconds' % (len(tarballs), time.time() - start))
+
+
+#
+# write a mapping file, in the same format as the hand-maintained ones, so they
+# diff sensibly
+#
+
+def write_map(name, mapping, fmt):
+    path = os.path.join(mapindex.basedir, name)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write('{\n')
+        for k in sorted(mapping):
+            f.write(' %r: %s,\n' % (k, fmt % ', '.join([repr(v) for v in sorted(mapping[k])])))
+        f.write('}\n')
+    os.replace(tmp, path)
+
+
+def write_json(path, obj):
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    index(sys.argv[1:] or ['x86_64'])
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Jon Turney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+#
+# A cache of build results
+#
+# Building the same srcpkg, with the same dependencies, in the same base VM
+# image, with the same build scripts, should give the same result, so the
+# products and build log of a successful build are kept, keyed by a hash of all
+# those inputs, and a job with the same inputs can use them rather than
+# building again.
+#
+# The outcome of verifying the products is kept too, along with a digest of the
+# upload it was verified against, so it can be reused if the upload is the same.
+#
+# Results are evicted least recently used first, when the total size exceeds
+# the disk budget, or when they are too old.
+#
+
+from collections import namedtuple
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import libvirt
+
+import builder
+from cache import LRUCache, hash_file
+import mapindex
+
+RESULT_BUDGET = 32*1024*1024*1024
+RESULT_MAX_AGE = 30*24*60*60
+
+# the files in the guest which the build depends on
+BUILD_SCRIPTS = ['build.sh', 'wrapper.sh']
+
+Result = namedtuple('Result', 'key path logfile upload_digest valid')
+
+
+#
+# a digest of the upload, from it's file digests (see verify.digest_tree())
+#
+
+def upload_digest(digests):
+    return hashlib.sha256(json.dumps(sorted(digests.items())).encode()).hexdigest()
+
+
+# link a file, if possible, rather than copying it
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class ResultCache(LRUCache):
+    description = 'build result'
+
+    def __init__(self, dbpath, root, budget=RESULT_BUDGET, max_age=RESULT_MAX_AGE):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+        super().__init__(dbpath, 'results',
+                         'key text primary key, path text, size integer, upload_digest text, valid integer, created integer, last_used integer',
+                         budget, max_age)
+
+    # the key for building |srcpkg| as |package| for |arch|, or None if it
+    # can't be determined
+    def key(self, srcpkg, package, arch):
+        h = hashlib.sha256()
+        try:
+            base_file = builder.base_image(arch)
+        except libvirt.libvirtError:
+            logging.exception('failed to find base VM image for %s' % (arch))
+            return None
+        h.update(('%s\n%s\n%s\n%d\n%s\n%s\n%s\n' % (arch, builder.BASE_VMID[arch], base_file, os.path.getmtime(base_file),
+                                                  package.kind, package.script, package.depends)).encode())
+        for fn in BUILD_SCRIPTS:
+            hash_file(h, os.path.join(mapindex.basedir, fn))
+        hash_file(h, srcpkg)
+        return h.hexdigest()
+
+    # look up the result for |key|, returning None if there isn't one
+    def get(self, key):
+        with self.lock:
+            row = self._lookup(key, ['upload_digest', 'valid'])
+            if not row:
+                return None
+
+        return Result(key, os.path.join(row[0], 'products'), os.path.join(row[0], 'build.log'), row[1], row[2])
+
+    # fill |outdir| with the products of |result|, and copy it's build log to
+    # |logfile|, returning False if that fails (e.g. because it was evicted
+    # meanwhile)
+    def restore(self, result, outdir, logfile):
+        try:
+            shutil.copytree(result.path, outdir, copy_function=_link_or_copy, dirs_exist_ok=True)
+            shutil.copy2(result.logfile, logfile)
+        except OSError:
+            logging.exception('failed to restore build result %s' % (result.key))
+            shutil.rmtree(outdir, ignore_errors=True)
+            return False
+        return True
+
+    # keep the products in |outdir| and |logfile| as the result for |key|
+    #
+    # products which weren't fetched, because they were identical to the
+    # upload, are taken from |known|, a dict mapping the product path to the
+    # uploaded file
+    def put(self, key, outdir, logfile, known, upload_digest, valid):
+        path = os.path.join(self.root, key)
+
+        tmp = None
+        try:
+            # (concurrent jobs may be keeping a result for the same key)
+            tmp = tempfile.mkdtemp(prefix=key + '.', suffix='.tmp', dir=self.root)
+            products = os.path.join(tmp, 'products')
+            shutil.copytree(outdir, products, copy_function=_link_or_copy)
+            shutil.copy2(logfile, os.path.join(tmp, 'build.log'))
+
+            for (fn, upload) in known.items():
+                if not os.path.exists(os.path.join(products, fn)):
+                    os.makedirs(os.path.dirname(os.path.join(products, fn)), exist_ok=True)
+                    _link_or_copy(upload, os.path.join(products, fn))
+
+            size = sum([os.path.getsize(os.path.join(d, f)) for (d, _, files) in os.walk(tmp) for f in files])
+
+            with self.lock:
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+                os.rename(tmp, path)
+                self.conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  (key, path, size, upload_digest, valid, time.time(), time.time()))
+                self.conn.commit()
+                self._trim()
+        except OSError:
+            logging.exception('failed to keep build result %s' % (key))
+            if tmp:
+                shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        logging.info('kept build result %s' % (path))
+
+    # record the verification outcome of a result against a different upload
+    def update_valid(self, key, upload_digest, valid):
+        with self.lock:
+            self.conn.execute('UPDATE results SET upload_digest = ?, valid = ? WHERE key = ?', (upload_digest, valid, key))
+            self.conn.commit()
+
+    def _remove(self, path):
+        shutil.rmtree(path, ignore_errors=True)
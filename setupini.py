@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Jon Turney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+#
+# The package dependency graph from a setup.ini in a local mirror
+#
+# This is used to reduce a set of build dependencies to the minimal set which
+# needs to be passed to setup: setup installs the transitive closure of the
+# packages it's asked for anyhow, so anything already in the base VM image
+# (which has the Base category and cygport installed), or which is required
+# (directly or indirectly) by another dependency, can be dropped.
+#
+# The graph for each arch is loaded when first used, and reloaded when the
+# setup.ini changes.
+#
+
+from collections import namedtuple
+import hashlib
+import logging
+import os
+import re
+import threading
+
+MIRROR = '/var/ftp/pub/cygwin'
+
+# what's installed in the base VM image (see build-vm-image-notes.txt)
+BASE_CATEGORY = 'Base'
+BASE_PACKAGES = ['cygport']
+
+Package = namedtuple('Package', 'categories requires')
+
+
+class PackageGraph:
+    def __init__(self, path):
+        self.packages = {}
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            content = f.read()
+        h.update(content)
+        self.version = h.hexdigest()
+
+        self._parse(content.decode(errors='replace'))
+
+        self.base = self.closure([p for p in self.packages if BASE_CATEGORY in self.packages[p].categories] +
+                                 [p for p in BASE_PACKAGES if p in self.packages])
+
+    def _parse(self, content):
+        name = None
+        categories = []
+        requires = []
+        quoted = False
+        current = False
+
+        def add():
+            if name:
+                self.packages[name] = Package(frozenset(categories), frozenset(requires))
+
+        for l in content.splitlines():
+            # skip over the continuation lines of multi-line quoted values
+            # (e.g. ldesc:)
+            if quoted:
+                if l.rstrip().endswith('"'):
+                    quoted = False
+                continue
+
+            if l.startswith('@ '):
+                add()
+                name = l[2:].strip()
+                categories = []
+                requires = []
+                current = True
+                continue
+
+            # only the fields of the current version matter, not [prev] or [test]
+            if l.startswith('['):
+                current = False
+                continue
+
+            match = re.match(r'^([\w-]+):\s*(.*)$', l)
+            if not match:
+                continue
+
+            (field, value) = match.groups()
+            if value.startswith('"') and (len(value) == 1 or not value.rstrip().endswith('"')):
+                quoted = True
+                continue
+
+            if not current:
+                continue
+
+            if field == 'category':
+                categories = value.split()
+            elif field == 'requires':
+                requires = value.split()
+            elif field == 'depends2':
+                # a comma separated list, with optional version relations
+                requires = [re.sub(r'\(.*\)', '', d).strip() for d in value.split(',')]
+                requires = [d for d in requires if d]
+
+        add()
+
+    # the transitive closure of |names| under requires
+    def closure(self, names):
+        seen = set()
+        todo = list(names)
+        while todo:
+            p = todo.pop()
+            if p in seen:
+                continue
+            seen.add(p)
+            if p in self.packages:
+                todo.extend(self.packages[p].requires)
+        return seen
+
+    # reduce |depends| to the minimal set which installs the same packages on
+    # top of the base image
+    def minimal(self, depends):
+        unknown = set([d for d in depends if d not in self.packages])
+        wanted = set(depends) - unknown - self.base
+
+        # what each dependency requires, directly or indirectly, but not itself
+        reach = {d: self.closure(self.packages[d].requires) for d in wanted}
+
+        minimal = set()
+        for d in wanted:
+            # drop a dependency which is required by another one (of a group
+            # which require each other, keep the first)
+            if any([(d in reach[e]) and ((e not in reach[d]) or (e < d)) for e in wanted if e != d]):
+                continue
+            minimal.add(d)
+
+        return (minimal | unknown, self.closure(minimal) - self.base)
+
+
+_graphs = {}
+_lock = threading.Lock()
+
+#
+# the package graph for |arch|, or None if there's no setup.ini
+#
+
+def graph(arch, mirror=MIRROR):
+    path = os.path.join(mirror, arch, 'setup.ini')
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    stat = (st.st_mtime_ns, st.st_size)
+
+    with _lock:
+        if (path not in _graphs) or (_graphs[path][0] != stat):
+            logging.info('loading package graph from %s' % (path))
+            _graphs[path] = (stat, PackageGraph(path))
+
+        return _graphs[path][1]
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    logging.basicConfig(level=logging.INFO)
+
+    # usage: setupini.py arch package...
+    start = time.time()
+    g = graph(sys.argv[1])
+    if g is None:
+        sys.exit('no setup.ini for %s' % (sys.argv[1]))
+    print('loaded %d packages, %d in base, in %.2f seconds' % (len(g.packages), len(g.base), time.time() - start))
+
+    (minimal, installs) = g.minimal(sys.argv[2:])
+    print('minimal: %s' % (','.join(sorted(minimal))))
+    print('installs %d packages' % (len(installs)))
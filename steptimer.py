@@ -24,47 +24,99 @@
 #
 # Utility for timing the steps of the build process
 #
+# Each job (or pool VM) has it's own StepTimer, so concurrent builds don't mix
+# up their timings.  The start and end of each step are measured with the
+# monotonic clock, and kept as offsets from when the timer was created, so they
+# can be stored in the steps table (see jobstore.JobStore.record_steps()).
+#
+# 'python3 steptimer.py report N' prints percentiles of the duration of each
+# step over the last N jobs.
+#
 
+import sqlite3
 import time
 from datetime import timedelta
 
-steptimes = []
-# XXX: this is bad and I feel bad
+PERCENTILES = [50, 90, 99]
+
+
+class StepTimer:
+    def __init__(self):
+        self.origin = time.monotonic()
+        self.last = self.origin
+        # a list of (name, start, end)
+        self.steps = []
 
-def mark(name):
-    steptimes.append((name, time.time()))
+    # the step |name| ended now (and started when the previous one ended)
+    def mark(self, name):
+        now = time.monotonic()
+        self.steps.append((name, self.last - self.origin, now - self.origin))
+        self.last = now
+
+    # the name and duration of each step so far
+    def durations(self):
+        return [(n, e - s) for (n, s, e) in self.steps]
+
+    def report(self):
+        total_time = time.monotonic() - self.origin
+        out = ['%s %s' % (n, format_delta(d)) for (n, d) in self.durations()]
+        return 'total time %s (%s)' % (format_delta(total_time), ', '.join(out))
 
-def start():
-    steptimes.clear()
-    mark('--start--')
 
 def format_delta(e):
     e = round(e+0.5)
     return timedelta(seconds=e)
 
-def report():
-    end_time = time.time()
+#
+# the |p|th percentile of |values|, which are sorted (by the nearest rank
+# method)
+#
+
+def percentile(values, p):
+    rank = max(1, -(-len(values) * p // 100))
+    return values[rank - 1]
 
-    out = []
-    for (n,t) in steptimes:
-        if n != '--start--':
-            e = t - prev_time
-            out.append('%s %s' % (n, format_delta(e)))
-        else:
-            start_time = t
+#
+# report percentiles of the duration of each step, over the last |n| jobs in the
+# database |dbpath|
+#
 
-        prev_time = t
+def report(dbpath, n):
+    conn = sqlite3.connect(dbpath, timeout=60)
+    rows = conn.execute('''SELECT step, duration FROM steps WHERE jobid IN
+                           (SELECT DISTINCT jobid FROM steps ORDER BY jobid DESC LIMIT ?)
+                           ORDER BY MIN(start_offset) OVER (PARTITION BY step), step''', (n,))
 
-    total_time = end_time - start_time
-    return 'total time %s (%s)' % (format_delta(total_time), ', '.join(out))
+    # steps are reported in the order they (first) happen
+    durations = {}
+    for (step, duration) in rows:
+        durations.setdefault(step, []).append(duration)
+
+    out = ['%-12s %6s %10s' % ('step', 'count', 'mean') +
+           ''.join(['%10s' % ('p%d' % p) for p in PERCENTILES]) + '%10s' % ('max')]
+    for (step, values) in durations.items():
+        values.sort()
+        out.append('%-12s %6d %10s' % (step, len(values), format_delta(sum(values) / len(values))) +
+                   ''.join(['%10s' % (format_delta(percentile(values, p))) for p in PERCENTILES]) +
+                   '%10s' % (format_delta(values[-1])))
+    return '\n'.join(out)
 
 
 if __name__ == "__main__":
-    start()
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'report':
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+        dbpath = sys.argv[3] if len(sys.argv) > 3 else '/var/lib/carpetbag/carpetbag.db'
+        print(report(dbpath, n))
+        sys.exit(0)
+
+    timer = StepTimer()
     time.sleep(1)
-    mark('clone')
+    timer.mark('clone')
     time.sleep(2)
-    mark('startup')
+    timer.mark('startup')
     time.sleep(3)
-    mark('build')
-    print(report())
+    timer.mark('build')
+    print(timer.report())
+    print(timer.steps)
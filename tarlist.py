@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Jon Turney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+#
+# List the members of a compressed tar archive, quickly
+#
+# Decompression is the expensive part of listing an archive, so where a
+# (multi-threaded, if possible) external decompressor is available, the archive
+# is decompressed by that, and the tar stream is piped into tarfile, which only
+# has to walk the member headers.  Otherwise, tarfile does it all.
+#
+# Members are described by their name, type, mode, size and (optionally) a
+# digest of their content, and are produced as the archive is read, so the
+# archive never needs to be held in memory, and a comparison can stop early.
+#
+# Listings of uploaded archives are also cached, by a digest of their content,
+# so verifying the same upload again doesn't decompress it again.
+#
+
+from collections import namedtuple
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+import time
+
+CACHE_DIR = '/var/lib/carpetbag/listings'
+# cached listings which haven't been used for this long are removed
+CACHE_MAX_AGE = 30*24*60*60
+
+# decompressors for each compression, in order of preference
+#
+# (plain bzip2 and gzip aren't worth using, as they are no faster than the
+# modules tarfile uses, but xz is, even when it can't use multiple threads)
+DECOMPRESSORS = {
+    '.xz': [['xz', '-T0', '-dc']],
+    '.lzma': [['xz', '--format=lzma', '-dc']],
+    '.bz2': [['lbzip2', '-dc'], ['pbzip2', '-dc']],
+    '.gz': [['pigz', '-dc']],
+}
+
+_lock = threading.Lock()
+_found = {}
+_pruned = False
+
+
+# the first available decompressor for |path|, or None
+def decompressor(path):
+    ext = os.path.splitext(path)[1]
+
+    with _lock:
+        if ext not in _found:
+            _found[ext] = None
+            for cmd in DECOMPRESSORS.get(ext, []):
+                if shutil.which(cmd[0]):
+                    _found[ext] = cmd
+                    break
+        return _found[ext]
+
+
+Member = namedtuple('Member', 'name type mode size digest')
+
+_types = {
+    tarfile.REGTYPE: 'file',
+    tarfile.AREGTYPE: 'file',
+    tarfile.CONTTYPE: 'file',
+    tarfile.DIRTYPE: 'dir',
+    tarfile.SYMTYPE: 'symlink',
+    tarfile.LNKTYPE: 'hardlink',
+    tarfile.CHRTYPE: 'char',
+    tarfile.BLKTYPE: 'block',
+    tarfile.FIFOTYPE: 'fifo',
+}
+
+
+def _member(tf, m, digests):
+    digest = None
+    if digests and m.isfile():
+        h = hashlib.sha256()
+        f = tf.extractfile(m)
+        while True:
+            b = f.read(1024*1024)
+            if not b:
+                break
+            h.update(b)
+        digest = h.hexdigest()
+    elif m.issym() or m.islnk():
+        # the link target is the content
+        digest = m.linkname
+
+    return Member(m.name, _types.get(m.type, 'unknown'), m.mode, m.size, digest)
+
+#
+# generate the members of the archive |path|, in archive order, with digests
+# of the content of files if |digests|
+#
+
+def iter_archive(path, digests=False):
+    cmd = decompressor(path)
+    if cmd is None:
+        with tarfile.open(path, mode='r|*') as tf:
+            for m in tf:
+                yield _member(tf, m, digests)
+        return
+
+    complete = False
+    with subprocess.Popen(cmd + [path], stdout=subprocess.PIPE, stderr=subprocess.PIPE) as p:
+        try:
+            with tarfile.open(fileobj=p.stdout, mode='r|') as tf:
+                for m in tf:
+                    yield _member(tf, m, digests)
+            # drain anything after the end-of-archive marker, so the
+            # decompressor exits
+            while p.stdout.read(1024*1024):
+                pass
+            complete = True
+        except tarfile.TarError:
+            # report the decompressor failing, rather than the truncated tar
+            # stream that results (the decompressor must be stopped first, as
+            # it may still be writing, e.g. if the content isn't a tar, and
+            # only an exit status which isn't from that is an error)
+            p.kill()
+            (_, stderr) = p.communicate()
+            if p.returncode > 0:
+                raise tarfile.ReadError('%s failed on %s: %s' % (cmd[0], path, stderr.decode(errors='replace').strip()))
+            raise
+        finally:
+            # (stopped early, or failed)
+            if not complete:
+                p.kill()
+
+        stderr = p.stderr.read()
+
+    if p.returncode != 0:
+        raise tarfile.ReadError('%s failed on %s: %s' % (cmd[0], path, stderr.decode(errors='replace').strip()))
+
+#
+# the member names of the archive |path|, in archive order (as
+# tarfile.getnames() would give)
+#
+
+def list_archive(path):
+    return [m.name for m in iter_archive(path)]
+
+#
+# as iter_archive(), but as a list, using a cached listing if there is one
+#
+
+def cached_members(path, digests=False):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            b = f.read(1024*1024)
+            if not b:
+                break
+            h.update(b)
+
+    fn = os.path.join(CACHE_DIR, '%s.%s.json' % (h.hexdigest(), 'digests' if digests else 'members'))
+    try:
+        with open(fn) as f:
+            members = [Member(*m) for m in json.load(f)]
+        os.utime(fn)
+        return members
+    except (OSError, ValueError, TypeError):
+        pass
+
+    members = list(iter_archive(path, digests))
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        _prune()
+        tmp = '%s.%d.tmp' % (fn, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(members, f)
+        os.replace(tmp, fn)
+    except OSError as e:
+        logging.warning('failed to cache listing of %s: %s' % (path, e))
+
+    return members
+
+
+# remove cached listings which haven't been used for a while (once per process)
+def _prune():
+    global _pruned
+    with _lock:
+        if _pruned:
+            return
+        _pruned = True
+
+    for f in os.listdir(CACHE_DIR):
+        fn = os.path.join(CACHE_DIR, f)
+        try:
+            if os.path.getmtime(fn) + CACHE_MAX_AGE < time.time():
+                os.remove(fn)
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    import sys
+
+    # compare listing with tarfile and with this
+    for path in sys.argv[1:]:
+        start = time.time()
+        with tarfile.open(path) as tf:
+            expected = tf.getnames()
+        t_tarfile = time.time() - start
+
+        start = time.time()
+        names = list_archive(path)
+        t_list = time.time() - start
+
+        assert names == expected
+        print('%s: %d members, tarfile %.2f seconds, %s %.2f seconds' % (path, len(names), t_tarfile, (decompressor(path) or ['tarfile'])[0], t_list))
@@ -21,14 +21,23 @@
 # THE SOFTWARE.
 #
 
+import concurrent.futures
 import difflib
 import filecmp
+import hashlib
+import itertools
 import logging
+import multiprocessing
 import os
 import pprint
 import re
 import sys
-import tarfile
+import threading
+
+import tarlist
+
+# the number of processes comparing files
+VERIFY_WORKERS = os.cpu_count() or 4
 
 #
 # capture a directory tree as a dict 'tree', where each key is a directory path
@@ -43,6 +52,58 @@ def capture_dirtree(basedir):
     return tree
 
 
+# the same, for a tree described by a list of file paths
+def paths_dirtree(paths):
+    tree = {'.': []}
+    for p in paths:
+        d = os.path.dirname(p) or '.'
+        tree.setdefault(d, []).append(os.path.basename(p))
+        while d != '.':
+            d = os.path.dirname(d) or '.'
+            tree.setdefault(d, [])
+
+    return {d: sorted(tree[d]) for d in tree}
+
+#
+# digests of files, as a dict where each key is a file path and the value is
+# a tuple (size, sha256)
+#
+
+def digest_file(fn):
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        while True:
+            b = f.read(1024*1024)
+            if not b:
+                break
+            h.update(b)
+    return (os.path.getsize(fn), h.hexdigest())
+
+
+def digest_tree(basedir):
+    digests = {}
+    for dirpath, dirnames, filenames in os.walk(basedir):
+        for f in filenames:
+            fn = os.path.join(dirpath, f)
+            digests[os.path.relpath(fn, basedir)] = digest_file(fn)
+
+    return digests
+
+
+# read the digests written by build.sh, for files under |prefix| (and relative
+# to it)
+def read_digests(fn, prefix='.'):
+    digests = {}
+    with open(fn) as f:
+        for l in f:
+            (sha256, size, path) = l.rstrip('\n').split(' ', 2)
+            path = os.path.relpath(path, prefix)
+            if not path.startswith('..'):
+                digests[path] = (int(size), sha256)
+
+    return digests
+
+
 def datadiff(a, b):
     return '\n' + '\n'.join(difflib.unified_diff(
         pprint.pformat(a).splitlines(),
@@ -50,32 +111,252 @@ def datadiff(a, b):
         fromfile='upload', tofile='built')).replace('\n\n','\n')
 
 
+#
+# compare archives member by member, in lockstep, as the built archive is read,
+# and stop after MAX_DIFFS differences
+#
+# members are compared by name, type, mode and size (which may differ by a bit,
+# as rebuilt binaries aren't identical), and by content digest too if
+# |member_digests| (which is usually too strict, for the same reason)
+#
+# (the listing of the uploaded archive is cached, as the same upload may be
+# verified again, but the built archive is new every time)
+#
+
+member_digests = False
+# a difference in member size which is less than this fraction (or less than
+# SIZE_SLACK bytes) isn't reported
+SIZE_TOLERANCE = 0.1
+SIZE_SLACK = 4096
+# the most differences reported for a file
+MAX_DIFFS = 20
+
+def compare_members(a, b):
+    diffs = []
+
+    # members seen in one archive but not yet in the other (so a member which
+    # is missing, or out of order, doesn't make all the following ones differ)
+    pending_a = {}
+    pending_b = {}
+
+    for (am, bm) in itertools.zip_longest(a, b):
+        if len(diffs) >= MAX_DIFFS:
+            break
+
+        if am and bm and (am.name == bm.name):
+            compare_member(am, bm, diffs)
+            continue
+
+        if am:
+            if am.name in pending_b:
+                compare_member(am, pending_b.pop(am.name), diffs)
+            else:
+                pending_a[am.name] = am
+
+        if bm:
+            if bm.name in pending_a:
+                compare_member(pending_a.pop(bm.name), bm, diffs)
+            else:
+                pending_b[bm.name] = bm
+
+    diffs.extend([(n, 'only in upload', None, None) for n in pending_a])
+    diffs.extend([(n, 'only in built', None, None) for n in pending_b])
+
+    if len(diffs) > MAX_DIFFS:
+        diffs[MAX_DIFFS:] = [('...', 'more differences not shown', None, None)]
+
+    return diffs
+
+
+def compare_member(am, bm, diffs):
+    if am.type != bm.type:
+        diffs.append((am.name, 'type', am.type, bm.type))
+        return
+
+    if am.mode != bm.mode:
+        diffs.append((am.name, 'mode', '%o' % am.mode, '%o' % bm.mode))
+
+    if abs(am.size - bm.size) > max(SIZE_TOLERANCE * max(am.size, bm.size), SIZE_SLACK):
+        diffs.append((am.name, 'size', am.size, bm.size))
+
+    if (am.digest is not None) and (bm.digest is not None) and (am.digest != bm.digest):
+        diffs.append((am.name, 'content' if am.type == 'file' else 'target', am.digest, bm.digest))
+
+
+def format_diffs(diffs):
+    lines = []
+    for (name, what, a, b) in diffs:
+        if a is None:
+            lines.append('  %s: %s' % (name, what))
+        else:
+            lines.append('  %s: %s differs, upload %s, built %s' % (name, what, a, b))
+    return '\n' + '\n'.join(lines)
+
+
 def verify_archive(af, bf):
-    with tarfile.open(af) as a, tarfile.open(bf) as b:
-        # we want to ignore .sig files in source packages...
-        al = [f for f in a.getnames() if not f.endswith('.sig')]
-        bl = b.getnames()
-        if al != bl:
-            logging.warning(datadiff(al, bl))
-        return al == bl
+    # we want to ignore .sig files in source packages...
+    a = [m for m in tarlist.cached_members(af, member_digests) if not m.name.endswith('.sig')]
+    b = tarlist.iter_archive(bf, member_digests)
+    try:
+        diffs = compare_members(a, b)
+    finally:
+        b.close()
 
+    if diffs:
+        logging.warning(format_diffs(diffs))
+    return not diffs
+
+#
+# compare files, and if they differ, show a (bounded) diff if they are both
+# reasonably sized text, otherwise where they first differ
+#
+
+MAX_TEXT_DIFF = 1024*1024
+MAX_DIFF_LINES = 100
 
 def verify_file(af, bf):
     if filecmp.cmp(af, bf, shallow=False):
         return True
-    else:
-        with open(af) as a, open(bf) as b:
-            logging.warning(datadiff(a.read(),b.read()))
-        return False
 
+    logging.warning(filediff(af, bf))
+    return False
+
+
+def filediff(af, bf):
+    asize = os.path.getsize(af)
+    bsize = os.path.getsize(bf)
+
+    if max(asize, bsize) <= MAX_TEXT_DIFF:
+        with open(af, 'rb') as a, open(bf, 'rb') as b:
+            ac = a.read()
+            bc = b.read()
+
+        if (b'\0' not in ac) and (b'\0' not in bc):
+            diff = list(itertools.islice(difflib.unified_diff(
+                ac.decode(errors='replace').splitlines(),
+                bc.decode(errors='replace').splitlines(),
+                fromfile='upload', tofile='built', lineterm=''), MAX_DIFF_LINES + 1))
+            if len(diff) > MAX_DIFF_LINES:
+                diff[MAX_DIFF_LINES:] = ['...']
+            return '\n' + '\n'.join(diff)
+
+    # binary, or too big to diff
+    offset = 0
+    with open(af, 'rb') as a, open(bf, 'rb') as b:
+        while True:
+            ab = a.read(1024*1024)
+            bb = b.read(1024*1024)
+            if ab != bb:
+                offset += next((i for i, (x, y) in enumerate(zip(ab, bb)) if x != y), min(len(ab), len(bb)))
+                break
+            offset += len(ab)
+
+    return 'binary files differ, upload %d bytes, built %d bytes, first difference at offset %d' % (asize, bsize, offset)
+
+
+#
+# the per-file comparisons are made in a pool of processes, shared by all
+# verify() calls
+#
+# (this uses the fork start method, as main.py isn't safe to import again, as
+# the spawn and forkserver methods would.  A process forked while another
+# thread holds a lock (e.g. a logging handler's) can deadlock, so the pool must
+# be started by start_workers() before any threads are.  If it hasn't been, or
+# it breaks, files are compared in-process instead.)
+#
+
+_pool = None
+
+def start_workers(workers=VERIFY_WORKERS):
+    global _pool
+    if threading.active_count() > 1:
+        logging.warning('threads already running, not starting verification workers')
+        return
+
+    _pool = concurrent.futures.ProcessPoolExecutor(workers,
+                                                   mp_context=multiprocessing.get_context('fork'),
+                                                   initializer=_worker_init)
 
-def verify(indir, outdir):
+    # the worker processes are forked when the first task is submitted, so do
+    # that now
+    _pool.submit(int).result()
+
+
+def _discard_executor(pool):
+    global _pool
+    if _pool is pool:
+        _pool = None
+    pool.shutdown(wait=False)
+
+#
+# in a worker process, log records are captured rather than emitted, and
+# returned with the result, so the caller can log them in order (and they go to
+# the right job log)
+#
+
+class _CaptureHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+_capture = None
+
+def _worker_init():
+    global _capture
+    _capture = _CaptureHandler()
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(_capture)
+
+
+def _compare(inf, outf, fn):
+    _capture.records = []
+    result = _check(inf, outf, fn)
+    return (result, _capture.records)
+
+
+# (a file which can't be compared, e.g. because it's unreadable, is different)
+def _check(inf, outf, fn):
+    try:
+        if re.search(r'.tar.(bz2|gz|lzma|xz)$', fn):
+            result = verify_archive(inf, outf)
+        else:
+            result = verify_file(inf, outf)
+    except Exception as e:
+        logging.error('failed to compare %s: %s' % (fn, e))
+        result = False
+
+    if not result:
+        logging.warning('contents of %s are different' % fn)
+
+    return result
+
+
+#
+# compare the uploaded files in |indir| with the built files in |outdir|
+#
+# if |digests| of the built files are given, they describe what was built, and
+# only files which don't match the |upload_digests| need to be present in
+# |outdir| to be compared
+#
+
+def verify(indir, outdir, digests=None, upload_digests=None):
     valid = True
     logging.info('comparing uploaded %s and built %s' % (indir, outdir))
 
     # verify the set of built package files is the same
     indirtree = capture_dirtree(indir)
-    outdirtree = capture_dirtree(outdir)
+    if digests is not None:
+        outdirtree = paths_dirtree(digests)
+        if upload_digests is None:
+            upload_digests = digest_tree(indir)
+    else:
+        outdirtree = capture_dirtree(outdir)
+        upload_digests = {}
 
     # make a copy of indirtree, but replace .bz|.gz|.lzma extensions with .xz,
     # the current compression
@@ -91,30 +372,65 @@ def verify(indir, outdir):
         logging.info('file manifests match, %d files' % (sum([len(indirtree[p]) for p in indirtree])))
 
     # verify each built binary package contain the same filelist
+    files = []
+    matched = 0
     for dirpath, dirnames, filenames in os.walk(indir):
         relpath = os.path.relpath(dirpath, indir)
 
         for f in filenames:
-            if not os.path.exists(os.path.join(outdir, relpath, f)):
+            fn = os.path.normpath(os.path.join(relpath, f))
+
+            # identical content, so there's nothing more to compare
+            if (digests is not None) and (fn in digests) and (digests[fn] == upload_digests.get(fn)):
+                matched += 1
                 continue
 
-            fn = os.path.join(relpath, f)
-            # print(fn)
+            if not os.path.exists(os.path.join(outdir, fn)):
+                continue
 
-            inf = os.path.join(indir, relpath, f)
-            outf = os.path.join(outdir, relpath, f)
+            files.append(fn)
 
-            if re.search(r'.tar.(bz2|gz|lzma|xz)$', f):
-                result = verify_archive(inf, outf)
-            else:
-                result = verify_file(inf, outf)
+    if matched:
+        logging.info('%d files have identical digests' % (matched))
+
+    # compare files in parallel, but report on them in path order
+    pool = _pool
+    futures = []
+    for fn in sorted(files):
+        future = None
+        if pool:
+            try:
+                future = pool.submit(_compare, os.path.join(indir, fn), os.path.join(outdir, fn), fn)
+            except RuntimeError:
+                # (the pool is broken, or has been shut down, so compare the
+                # remaining files in-process)
+                _discard_executor(pool)
+                pool = None
+        futures.append((fn, future))
 
-            if not result:
-                logging.warning('contents of %s are different' % os.path.join(relpath, f))
+    for (fn, future) in futures:
+        records = []
+        if future is None:
+            result = _check(os.path.join(indir, fn), os.path.join(outdir, fn), fn)
+        else:
+            try:
+                (result, records) = future.result()
+            except concurrent.futures.process.BrokenProcessPool:
+                # a worker died, so stop using the pool (a new one can't
+                # safely be forked now), and check this file here instead
+                logging.warning('verification worker failed, comparing %s in-process' % fn)
+                if pool:
+                    _discard_executor(pool)
+                    pool = None
+                result = _check(os.path.join(indir, fn), os.path.join(outdir, fn), fn)
+            except Exception as e:
+                logging.error('failed to compare %s: %s' % (fn, e))
+                result = False
 
-            valid = valid and result
+        for (level, msg) in records:
+            logging.log(level, msg)
 
-            # XXX: major difference in filesizes, modes should be detected ???
+        valid = valid and result
 
     status = 'succeeded' if valid else 'failed'
     logging.info('package contents verification %s' % (status))
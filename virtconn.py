@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Jon Turney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+#
+# A single libvirt event loop thread, and a small pool of shared libvirt
+# connections
+#
+# Rather than each build running the libvirt event loop itself while it waits
+# for something to happen to it's domain, there is one thread which runs the
+# event loop.  Callbacks registered on one connection dispatch domain events to
+# whoever is waiting for them, and waiting is done on a concurrent.futures.Future
+# which completes when the event arrives (or a timeout expires).
+#
+
+import collections
+import concurrent.futures
+import libvirt
+import logging
+import threading
+
+URI = 'qemu:///system'
+
+# the number of connections to each hypervisor which are shared between builds
+CONNECTIONS = 4
+
+_lock = threading.Lock()
+_started = False
+_connections = collections.defaultdict(list)
+_next_connection = collections.defaultdict(int)
+# the connection to each hypervisor which domain events are delivered on
+# (events are registered for on only one, so each is only handled once)
+_event_connection = {}
+
+#
+# start the event loop thread (if it isn't already running)
+#
+# (this needs to happen before any connection is opened, for events to be
+# delivered on it)
+#
+
+def start():
+    global _started
+    with _lock:
+        if _started:
+            return
+
+        libvirt.virInitialize()
+        libvirt.virEventRegisterDefaultImpl()
+        threading.Thread(target=_event_loop_thread, name='libvirt-event-loop', daemon=True).start()
+        _started = True
+
+
+def _event_loop_thread():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+#
+# get one of the shared connections to |uri|
+#
+
+def connection(uri=URI):
+    start()
+
+    with _lock:
+        conns = _connections[uri]
+
+        # forget any connections which have been lost
+        for conn in [c for c in conns if not c.isAlive()]:
+            logging.warning('libvirt connection to %s lost' % (uri))
+            conns.remove(conn)
+            if _event_connection.get(uri) is conn:
+                del _event_connection[uri]
+
+        # open connections as needed, up to the limit, then share them
+        # round-robin
+        if len(conns) < CONNECTIONS:
+            conn = libvirt.open(uri)
+            if conn == None:
+                raise libvirt.libvirtError('Failed to open connection to the hypervisor %s' % (uri))
+
+            if uri not in _event_connection:
+                conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE, _agent_lifecycle_callback, None)
+                conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, _lifecycle_callback, None)
+                _event_connection[uri] = conn
+            conns.append(conn)
+            return conn
+
+        i = _next_connection[uri] % len(conns)
+        _next_connection[uri] = i + 1
+        return conns[i]
+
+#
+# waiting for domain events
+#
+
+class _Waiter:
+    def __init__(self, uuid, kind):
+        self.uuid = uuid
+        self.kind = kind
+        self.future = concurrent.futures.Future()
+        self.timer = None
+
+_waiters = collections.defaultdict(list)
+_waiters_lock = threading.Lock()
+
+
+def _wait(domain, kind, timeout):
+    w = _Waiter(domain.UUIDString(), kind)
+
+    with _waiters_lock:
+        _waiters[w.uuid].append(w)
+
+    if timeout is not None:
+        w.timer = libvirt.virEventAddTimeout(int(timeout*1000), _timeout_callback, w)
+
+    return w.future
+
+
+def _finish(w, result):
+    if w.timer is not None:
+        libvirt.virEventRemoveTimeout(w.timer)
+        w.timer = None
+    w.future.set_result(result)
+
+
+# complete all waiters for |kind| of event on the domain with |uuid|
+def _resolve(uuid, kind, result):
+    with _waiters_lock:
+        waiters = [w for w in _waiters[uuid] if w.kind == kind]
+        _waiters[uuid] = [w for w in _waiters[uuid] if w.kind != kind]
+        if not _waiters[uuid]:
+            del _waiters[uuid]
+
+    for w in waiters:
+        _finish(w, result)
+
+
+def _timeout_callback(timer, w):
+    logging.info("timeout event: domain %s waiting for %s" % (w.uuid, w.kind))
+
+    # (the event may have just arrived, in which case there's nothing to do)
+    with _waiters_lock:
+        if w not in _waiters.get(w.uuid, []):
+            return
+        _waiters[w.uuid].remove(w)
+
+    _finish(w, False)
+
+
+def _agent_lifecycle_callback(conn, dom, state, reason, opaque):
+    logging.info("agentLifecycle event: domain '%s' state %d reason %d" % (dom.name(), state, reason))
+    if state == libvirt.VIR_CONNECT_DOMAIN_EVENT_AGENT_LIFECYCLE_STATE_CONNECTED:
+        _resolve(dom.UUIDString(), 'agent', True)
+
+
+def _lifecycle_callback(conn, dom, event, detail, opaque):
+    if event in [libvirt.VIR_DOMAIN_EVENT_STOPPED, libvirt.VIR_DOMAIN_EVENT_CRASHED]:
+        logging.info("lifecycle event: domain '%s' stopped, event %d detail %d" % (dom.name(), event, detail))
+        # the agent isn't going to connect now
+        _resolve(dom.UUIDString(), 'agent', False)
+        _resolve(dom.UUIDString(), 'stopped', True)
+
+#
+# return a future which completes with True when the guest agent in |domain|
+# connects, or False if the domain stops or |timeout| seconds pass first
+#
+# (to avoid missing the event, call this before starting the domain)
+#
+
+def agent_connected(domain, timeout):
+    return _wait(domain, 'agent', timeout)
+
+#
+# return a future which completes with True when |domain| stops, or False if
+# |timeout| seconds pass first
+#
+
+def domain_stopped(domain, timeout):
+    return _wait(domain, 'stopped', timeout)
+
+
+#
+# exercise this with libvirt's test driver
+#
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    conn = connection('test:///default')
+    domain = conn.lookupByName('test')
+
+    # the test driver doesn't have a guest agent, so this should time out
+    assert agent_connected(domain, 1).result() == False
+
+    # destroying the domain should deliver a stopped event
+    stopped = domain_stopped(domain, 10)
+    agent = agent_connected(domain, 10)
+    domain.destroy()
+    assert stopped.result() == True
+    assert agent.result() == False
+
+    # and a shared connection should be reused
+    conns = set([connection('test:///default') for i in range(0, 2*CONNECTIONS)])
+    assert len(conns) == CONNECTIONS
+
+    print('ok')
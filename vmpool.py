@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Jon Turney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+#
+# A pool of already cloned and booted build VMs
+#
+# Cloning and booting a VM (and waiting for Windows to get to the point where
+# the guest agent is responsive) takes a significant amount of time, so we keep
+# a number of VMs for each arch booted and idle, ready to hand one to a build.
+#
+# Each slot in the pool has a thread which boots a VM, waits for it to be taken
+# by a build, and then boots a replacement.  The build which takes a VM owns it,
+# and is responsible for discarding it afterwards.
+#
+
+import collections
+import logging
+import threading
+import time
+
+import libvirt
+
+import builder
+from libvirt_qemu_ga_utils import guestPing
+from steptimer import StepTimer
+import virtconn
+
+
+class VMPool:
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.ready = collections.defaultdict(collections.deque)
+        self.cv = threading.Condition()
+        self.conn = None
+
+    # start the threads which fill the pool
+    def start(self):
+        try:
+            self.conn = virtconn.connection()
+        except libvirt.libvirtError:
+            logging.exception('Failed to open connection to the hypervisor, VM pool disabled')
+            return
+
+        for arch in self.sizes:
+            for slot in range(0, self.sizes[arch]):
+                threading.Thread(target=self._slot_thread, args=(arch, slot),
+                                 name='vmpool-%s-%d' % (arch, slot), daemon=True).start()
+
+    # take a booted VM for |arch| from the pool, or None if none are ready
+    #
+    # (a VM may have been waiting in the pool for a long time, so check it's
+    # guest agent is still responding, and discard it if it isn't)
+    def get(self, arch):
+        while True:
+            with self.cv:
+                if not self.ready[arch]:
+                    logging.info('no pooled VM ready for %s' % (arch))
+                    return None
+
+                vm = self.ready[arch].popleft()
+                self.cv.notify_all()
+
+            if guestPing(vm.domain):
+                return vm
+
+            logging.warning('pool VM %s guest agent not responding, discarding' % (vm.vmid))
+            try:
+                builder.destroy_vm(vm)
+            except (libvirt.libvirtError, OSError):
+                logging.exception('failed to destroy pool VM %s' % (vm.vmid))
+
+    def _slot_thread(self, arch, slot):
+        generation = 0
+        while True:
+            generation += 1
+            vmid = 'buildvm_pool_%s_%d_%d' % (arch, slot, generation)
+
+            try:
+                timer = StepTimer()
+                vm, responsive = builder.start_vm(self.conn, arch, vmid, timer=timer)
+            except libvirt.libvirtError:
+                logging.exception('failed to start pool VM %s' % (vmid))
+                time.sleep(60)
+                continue
+
+            # sometimes the guest agent doesn't start properly, so don't offer
+            # a VM which isn't going to be usable
+            if not responsive:
+                logging.warning('pool VM %s guest agent not responding, discarding' % (vmid))
+                builder.destroy_vm(vm)
+                continue
+
+            logging.info('pool VM %s ready, %s' % (vmid, timer.report()))
+
+            # offer it, and wait until it's been taken before booting another
+            with self.cv:
+                self.ready[arch].append(vm)
+                self.cv.wait_for(lambda: vm not in self.ready[arch])